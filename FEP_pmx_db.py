@@ -2,7 +2,15 @@
 
 import os
 import sys
+import json
+import time
+import glob
+import shutil
+import signal
+import socket
+import hashlib
 import sqlite3
+import threading
 import argparse
 import subprocess
 
@@ -20,6 +28,11 @@ def parse():
     parser.add_argument(
         '--stage',
         help="stages of calculations that will be added to calculations' list; comma separator is used")
+    parser.add_argument(
+        '--priority',
+        type=int,
+        default=0,
+        help="With --add, priority of the added directories; tasks with higher priority are submitted first")
     parser.add_argument(
         '--remove',
         help="folders that will be removed from calculations' list; comma separator is used")
@@ -31,13 +44,154 @@ def parse():
         '--run',
         action='store_true',
         help="Run one step for all tasks")
+    parser.add_argument(
+        '--chain',
+        action='store_true',
+        help="With --run or --daemon, submit all remaining stages of a task as SLURM jobs with afterok dependencies")
+    parser.add_argument(
+        '--executor',
+        choices=["inline", "local", "slurm"],
+        default="local",
+        help="How local stages (MD preparation, FEP preparation, result processing) are run: "
+        "inline - blocking `bash`, local - detached processes, slurm - SLURM jobs")
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=4,
+        help="Maximal number of local stages running at once with `--executor local`")
+    parser.add_argument(
+        '--prep_workers',
+        type=int,
+        default=8,
+        help="Number of parallel trjconv/grompp processes in FEP preparation")
+    parser.add_argument(
+        '--lazy_tpr',
+        action='store_true',
+        help="FEP preparation does not build per-frame tpr files, FEP jobs build them before mdrun")
+    parser.add_argument(
+        '--journal',
+        choices=["auto", "wal", "delete"],
+        default="auto",
+        help="SQLite journal mode; auto - WAL unless the database is on a network filesystem")
+    parser.add_argument(
+        '--lease_batch',
+        type=int,
+        default=500,
+        help="Number of tasks leased by a controller at once; other controllers process the rest")
+    parser.add_argument(
+        '--lease_ttl',
+        type=int,
+        default=3600,
+        help="Lease time of tasks, seconds; leases of crashed controllers are taken over after it")
+    parser.add_argument(
+        '--max_attempts',
+        type=int,
+        default=3,
+        help="Number of runs of an FEP frame before the task is marked as failed")
+    parser.add_argument(
+        '--md_mode',
+        choices=["sequential", "packed", "multidir"],
+        default="sequential",
+        help="How the four MD legs are run on a node: sequential - one after another, "
+        "packed - concurrent pinned mdrun processes with cores proportional to system size, multidir - `mdrun -multidir`")
+    parser.add_argument(
+        '--layout',
+        help="JSON file with the node layout (partition, partitions, cores_per_node, md_threads)")
+    parser.add_argument(
+        '--tune',
+        help="Directory of calculations (after MD preparation) whose water and protein systems are benchmarked "
+        "with several layouts on every partition; MD and FEP use the fastest layout of the closest system size")
+    parser.add_argument(
+        '--tune_steps',
+        type=int,
+        default=5000,
+        help="With --tune, number of mdrun steps of one benchmark")
+    parser.add_argument(
+        '--stage_limits',
+        help="Maximal numbers of SLURM jobs in flight per stage, e.g. `2:50,4:20`; comma separator is used")
+    parser.add_argument(
+        '--pack',
+        type=int,
+        default=1,
+        help="Number of directories whose MD or FEP is submitted as one SLURM job; 1 - every directory has its own jobs")
+    parser.add_argument(
+        '--adaptive',
+        type=int,
+        default=0,
+        help="Frames per batch of adaptive FEP: batches are run until the bootstrap SE of BAR dG of both legs "
+        "is below --target_se; 0 - all frames at once")
+    parser.add_argument(
+        '--target_se',
+        type=float,
+        default=0.5,
+        help="With --adaptive, target standard error of dG of each leg, kJ/mol")
+    parser.add_argument(
+        '--max_frames',
+        type=int,
+        help="With --adaptive, maximal number of frames per state; default is all frames")
+    parser.add_argument(
+        '--compact',
+        action='store_true',
+        help="Result processing packs dhdl*.xvg and dhdl*.log_gmx of every state into <state>/dhdl.tar.gz "
+        "and removes frames, tpr files and GROMACS backups")
+    parser.add_argument(
+        '--cache_dir',
+        help="Directory of the cache of water legs; directories with the same ligand pair reuse finished water legs")
+    parser.add_argument(
+        '--cache_size',
+        type=float,
+        default=500,
+        help="Maximal size of the cache of water legs, GB; least recently used entries are removed")
+    parser.add_argument(
+        '--md_time',
+        default="48:00:00",
+        help="Wall time of MD jobs; MD is continued from checkpoints by new jobs until it is finished")
+    parser.add_argument(
+        '--fep_time',
+        default="48:00:00",
+        help="Wall time of FEP jobs; unfinished frames are continued from checkpoints by new jobs")
+    parser.add_argument(
+        '--daemon',
+        action='store_true',
+        help="Run steps for all tasks until a signal (SIGINT/SIGTERM) is received")
+    parser.add_argument(
+        '--poll_min',
+        type=int,
+        default=60,
+        help="Minimal pause between passes in daemon mode, seconds")
+    parser.add_argument(
+        '--poll_max',
+        type=int,
+        default=900,
+        help="Maximal pause between passes in daemon mode, seconds")
     parser.add_argument(
         '--dump',
         action='store_true',
         help="Dump database")
+    parser.add_argument(
+        '--report',
+        action='store_true',
+        help="Print percentiles of stage latency, queue wait, run time and ns/day per stage, and core-hours per directory")
     parser.add_argument(
         '--dump_csv',
         help="Dump database to file")
+    parser.add_argument(
+        '--dump_json',
+        help="Dump database to JSON file (array of tasks)")
+    parser.add_argument(
+        '--summary',
+        action='store_true',
+        help="Print numbers of tasks per stage and status")
+    parser.add_argument(
+        '--filter_stage',
+        help="With --dump, --dump_csv, --dump_json and --summary, only tasks of these stages; comma separator is used")
+    parser.add_argument(
+        '--filter_status',
+        help="With --dump, --dump_csv, --dump_json and --summary, only tasks with these statuses "
+        "(numbers or names, e.g. `Failed,2`); comma separator is used")
+    parser.add_argument(
+        '--filter_dir',
+        help="With --dump, --dump_csv, --dump_json and --summary, only directories matching this pattern (e.g. `cdk*`)")
     args = parser.parse_args()
 
     if args.add != None and args.stage != None:
@@ -56,11 +210,151 @@ def parse():
         print("Both --add and --remove must not be defined!")
         sys.exit(1)
 
+    if args.stage_limits != None:
+        try:
+            args.stage_limits = {int(stage): int(limit) for stage, limit in
+                                 [item.split(":") for item in args.stage_limits.split(",")]}
+        except ValueError:
+            print("--stage_limits must be `stage:limit,stage:limit,...`!")
+            sys.exit(1)
+    if args.filter_stage != None:
+        try:
+            args.filter_stage = [int(stage) for stage in args.filter_stage.split(",")]
+        except ValueError:
+            args.filter_stage = [0]
+        if not all(1 <= stage <= 5 for stage in args.filter_stage):
+            print("--filter_stage must be stages from 1 to 5!")
+            sys.exit(1)
+    if args.filter_status != None:
+        # names are case-insensitive, `In progress` is `In progress...`
+        names = {name.lower().rstrip("."): status for name, status in FEPdb.STATUS_rev.items()}
+        statuses = []
+        for status in args.filter_status.split(","):
+            status = status.strip()
+            if status.isdigit() and int(status) in FEPdb.STATUS:
+                statuses.append(int(status))
+            elif status.lower().rstrip(".") in names:
+                statuses.append(names[status.lower().rstrip(".")])
+            else:
+                print(f"--filter_status: unknown status `{status}`!")
+                sys.exit(1)
+        args.filter_status = statuses
+    if args.adaptive < 0:
+        print("--adaptive must not be negative!")
+        sys.exit(1)
+    if args.pack < 1:
+        print("--pack must be positive!")
+        sys.exit(1)
+    if args.tune_steps < 1:
+        print("--tune_steps must be positive!")
+        sys.exit(1)
+    if args.run and args.daemon:
+        print("Both --run and --daemon must not be defined!")
+        sys.exit(1)
+    # next stages of a chain are prepared before their inputs (emout.gro, checked results) exist;
+    # result processing of a chain compacts the frames before FEP is checked
+    if args.chain and (args.md_mode == "packed" or args.cache_dir != None or args.adaptive > 0 or args.tune != None or args.compact):
+        print("--chain must not be used with --md_mode packed, --cache_dir, --adaptive, --tune and --compact!")
+        sys.exit(1)
+    if not 0 < args.poll_min <= args.poll_max:
+        print("0 < --poll_min <= --poll_max is required!")
+        sys.exit(1)
+    if args.layout != None:
+        try:
+            args.layout = load_layout(args.layout)
+        except (OSError, ValueError) as e:
+            print(f"--layout: {e}")
+            sys.exit(1)
+    try:
+        SLURMseconds(args.md_time)
+        SLURMseconds(args.fep_time)
+    except ValueError:
+        print("--md_time and --fep_time must be in SLURM format ([days-]hours:minutes:seconds)!")
+        sys.exit(1)
+
     return args
 
 
-def SLURMscript(script, nodes=1, ntasks=1, ntasks_per_node=48, jobname="", time="48:00:00", partition="hpc4-3d"):
-    cpus_per_task = 48 * nodes // ntasks
+# node layout; keys may be overridden by a JSON file (`--layout`)
+LAYOUT = {"partition": "hpc4-3d",
+          "partitions": {},  # partition: maximal number of jobs in flight (null - no limit), in order of preference
+          "cores_per_node": 48,
+          "md_threads": 24,  # OpenMP threads of sequential MD
+          "scratch": ""}  # node-local directory of FEP outputs ('' - the directory of calculations)
+
+
+def load_layout(filename):
+    layout = dict(LAYOUT)
+    custom = json.load(open(filename))
+    unknown = [key for key in custom if key not in LAYOUT]
+    if unknown != []:
+        raise ValueError(f"unknown keys {', '.join(unknown)} in '{filename}'")
+    layout.update(custom)
+    return layout
+
+
+def TUNElayouts(cores):
+    # MPI ranks x OpenMP threads x PME ranks of a whole node: ranks are powers of 2,
+    # a quarter of them does PME with 8 and more ranks
+    layouts = []
+    ranks = 1
+    while ranks <= cores:
+        if cores % ranks == 0:
+            layouts.append((ranks, cores // ranks, 0))
+            if ranks >= 8:
+                layouts.append((ranks, cores // ranks, ranks // 4))
+        ranks *= 2
+    return layouts
+
+
+def TUNEscript(directory, systems, cores, steps):
+    # short mdrun benchmarks of `systems` ((atoms, tpr) pairs) on one node: MD with every
+    # layout of the node, FEP with every number of concurrent single-rank frames;
+    # logs are `<stage>-<atoms>-<ranks>-<threads>-<npme>-<copy>.log`, see `FEPdb.collect_tuning`
+    runs = []
+    for atoms, tpr in systems:
+        for ranks, threads, npme in TUNElayouts(cores):
+            runs.append(f"bench 2-{atoms}-{ranks}-{threads}-{npme}-0 {tpr} {ranks} {threads} {npme} 0")
+        for copies, threads, npme in TUNElayouts(cores):
+            if npme != 0:
+                continue
+            runs += [f"bench 4-{atoms}-{copies}-{threads}-0-{copy} {tpr} 1 {threads} 0 {copy * threads} &"
+                     for copy in range(copies)] + ["wait"]
+    runs = "\n".join(runs)
+    return f"""#!/usr/bin/env bash
+
+module load anaconda3/python3-5.1.0 openmpi/4.1.0 gromacs/2021
+#
+export GMX_MAXBACKUP=-1
+#
+pushd {directory}
+#
+bench() {{
+    # $1 - name, $2 - tpr, $3 - MPI ranks, $4 - OpenMP threads, $5 - PME ranks, $6 - first core
+    OMP_NUM_THREADS=$4 mpirun -n $3 --oversubscribe --bind-to none gmx_mpi mdrun -s $2 -deffnm $1 -nsteps {steps} -resethway -noconfout \\
+        -ntomp $4 -npme $5 -pin on -pinoffset $6 -pinstride 1 > $1.out 2>&1
+    rm -f $1.edr $1.trr $1.xtc $1.cpt $1.gro $1.out
+}}
+#
+{runs}
+#
+popd
+"""
+
+
+def best_layout(layouts, atoms):
+    # (ranks, threads, npme) of the benchmark of the closest system size, see `--tune`;
+    # None if nothing is benchmarked or the size is unknown
+    if layouts == [] or atoms == None:
+        return None
+    return min(layouts, key=lambda layout: max(layout[0] / atoms, atoms / layout[0]))[1:]
+
+
+def SLURMscript(script, nodes=1, ntasks=1, ntasks_per_node=48, jobname="", time="48:00:00", partition="hpc4-3d",
+                cores_per_node=48, srun=True):
+    # srun=False: the script is run once and starts MPI ranks by itself
+    cpus_per_task = cores_per_node * nodes // ntasks
+    launcher = "srun " if srun else ""
     return f"""#!/bin/bash
 #SBATCH --nodes={nodes}
 #SBATCH --ntasks={ntasks}
@@ -73,18 +367,25 @@ def SLURMscript(script, nodes=1, ntasks=1, ntasks_per_node=48, jobname="", time=
 #SBATCH --get-user-env
 #SBATCH --partition={partition}
 
-srun bash {script}
+{launcher}bash {script}
 """
 
 
-def SLURMbatch(script, array=None):
-    if array == None:
-      out, err = subprocess.Popen(
-          f"sbatch {script}", stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True).communicate()
-    else:
-      arrt = array - 1
-      out, err = subprocess.Popen(
-          f"sbatch --array=0-{arrt} {script}", stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True).communicate()
+def SLURMbatch(script, array=None, dependency=None, partition=None, chain=False):
+    options = ""
+    if chain:
+        # scripts of a chain fail when their results are incomplete, see `MD.prepare` and `FEP.prepare`
+        options += "--export=ALL,FEP_CHAIN=1 "
+    if partition != None:
+        # overrides `#SBATCH --partition` of the script
+        options += f"--partition={partition} "
+    if array != None:
+        arrt = array - 1
+        options += f"--array=0-{arrt} "
+    if dependency != None:
+        options += f"--dependency=afterok:{dependency} "
+    out, err = subprocess.Popen(
+        f"sbatch {options}{script}", stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True).communicate()
     out = out.decode('ascii')
     task = "ERROR_SLURM"
     if "Submitted batch job" in out:
@@ -92,23 +393,343 @@ def SLURMbatch(script, array=None):
     return task
 
 
-def SLURMwait(taskIDs):
-    taskIDs = taskIDs.replace(";", ",")
+SLURM_FAILED = ("FAILED", "TIMEOUT", "CANCELLED", "NODE_FAIL", "OUT_OF_MEMORY",
+                "BOOT_FAIL", "DEADLINE", "PREEMPTED", "REVOKED")
+# jobs stopped by the scheduler, not by an error of the job itself
+SLURM_RESUMABLE = ("TIMEOUT", "PREEMPTED")
+# squeue or sacct has failed (e.g. slurmctld or slurmdbd timeout): the state of the job is not known
+SLURM_UNAVAILABLE = "UNAVAILABLE"
+
+
+def SLURMseconds(time):
+    # `[days-]hours:minutes:seconds` or `minutes` of SLURM to seconds
+    days, _, time = time.rpartition("-")
+    parts = [int(part) for part in time.split(":")]
+    if days == "" and len(parts) < 3:
+        # minutes[:seconds]
+        parts = [0] + parts + [0] * (2 - len(parts))
+    else:
+        parts = parts + [0] * (3 - len(parts))
+    hours, minutes, seconds = parts
+    return ((int(days or 0) * 24 + hours) * 60 + minutes) * 60 + seconds
+
+
+def SLURMjobs(taskIDs):
+    jobs = []
+    for taskID in taskIDs:
+        for job in taskID.split(";"):
+            if job.startswith("pack:"):
+                # a job shared by several directories
+                job = job[5:]
+            if job != "" and not job.startswith("local:") and job not in jobs:
+                jobs.append(job)
+    return jobs
+
+
+def SLURMstates(taskIDs):
+    # one squeue and at most one sacct call for all jobs of the pass;
+    # result: {jobID: {array element ("" for plain jobs): state}}
+    jobs = SLURMjobs(taskIDs)
+    states = {}
+    if jobs == []:
+        return states
+    process = subprocess.Popen(
+        f"squeue -h -r -o '%i|%T' -j {','.join(jobs)}", stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
+    out, err = process.communicate()
+    # squeue fails with `Invalid job id` if none of the jobs is known to slurmctld anymore
+    if process.returncode != 0 and b"Invalid job id" not in err:
+        print(f"squeue has failed: {err.decode('ascii', errors='ignore').strip()}")
+        return {job: {"": SLURM_UNAVAILABLE} for job in jobs}
+    for line in out.decode('ascii').split("\n"):
+        if "|" not in line:
+            continue
+        jobID, state = line.strip().split("|")[:2]
+        job, _, element = jobID.partition("_")
+        states.setdefault(job, {})[element] = state
+    finished = [job for job in jobs if job not in states]
+    if finished == []:
+        return states
+    process = subprocess.Popen(
+        f"sacct -n -P -X -o JobID,State -j {','.join(finished)}", stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
+    out, err = process.communicate()
+    if process.returncode != 0:
+        print(f"sacct has failed: {err.decode('ascii', errors='ignore').strip()}")
+        states.update({job: {"": SLURM_UNAVAILABLE} for job in finished})
+        return states
+    for line in out.decode('ascii').split("\n"):
+        if "|" not in line:
+            continue
+        jobID, state = line.strip().split("|")[:2]
+        job, _, element = jobID.partition("_")
+        if job in states and element in states[job]:
+            continue
+        # `CANCELLED by 1234` -> `CANCELLED`
+        states.setdefault(job, {})[element] = state.split()[0] if state != "" else "UNKNOWN"
+    return states
+
+
+def SLURMtime(value):
+    # `2024-01-31T12:00:00` of sacct to Unix time; None for `Unknown`, `None` etc.
+    try:
+        return time.mktime(time.strptime(value, "%Y-%m-%dT%H:%M:%S"))
+    except ValueError:
+        return None
+
+
+def SLURMaccounting(jobs):
+    # one sacct call for finished jobs, array elements are summed up;
+    # result: {jobID: {partition, submit, start, end (Unix time), elapsed, cpu (seconds, cores * seconds)}}
+    accounting = {}
+    if jobs == []:
+        return accounting
     out, err = subprocess.Popen(
-        f"squeue -j {taskIDs}", stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True).communicate()
-    out = out.decode('ascii')
-    err = err.decode('ascii')
-    if "slurm_load_jobs error: Invalid job id specified" in err:
-        return "Done"
-    res = len(out.split("\n"))
-    if res > 2:
+        f"sacct -n -P -X -o JobID,Partition,Submit,Start,End,ElapsedRaw,CPUTimeRAW -j {','.join(jobs)}", stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True).communicate()
+    for line in out.decode('ascii').split("\n"):
+        fields = line.strip().split("|")
+        if len(fields) < 7:
+            continue
+        job = fields[0].partition("_")[0]
+        entry = accounting.setdefault(job, {"partition": fields[1], "submit": None, "start": None, "end": None,
+                                            "elapsed": 0, "cpu": 0})
+        for key, value, pick in (("submit", fields[2], min), ("start", fields[3], min), ("end", fields[4], max)):
+            value = SLURMtime(value)
+            if value != None:
+                entry[key] = value if entry[key] == None else pick(entry[key], value)
+        entry["elapsed"] += int(fields[5]) if fields[5].isdigit() else 0
+        entry["cpu"] += int(fields[6]) if fields[6].isdigit() else 0
+    return accounting
+
+
+def SLURMwait(taskIDs, states=None):
+    if states == None:
+        states = SLURMstates([taskIDs])
+    elements = {}
+    unknown = []
+    for job in SLURMjobs([taskIDs]):
+        if job not in states:
+            unknown.append(job)
+        for element, state in states.get(job, {}).items():
+            elements[f"{job}_{element}" if element != "" else job] = state
+    if unknown != []:
+        # a job is finished only when sacct reports its terminal state
+        print(f"Jobs {', '.join(unknown)} are unknown both to squeue and sacct, waiting")
+        return "Waiting"
+    if any(state not in SLURM_FAILED and state != "COMPLETED" for state in elements.values()):
+        # active, or squeue/sacct has failed, or a state is not known yet
         return "Waiting"
+    failed = {jobID: state for jobID, state in elements.items()
+              if state in SLURM_FAILED}
+    if failed != {}:
+        print(f"Jobs {taskIDs}: " +
+              ", ".join(f"{jobID} {state}" for jobID, state in sorted(failed.items())))
+        if all(state in SLURM_RESUMABLE for state in failed.values()):
+            return "Timeout"
+        return "Failed"
     return "Done"
 
 
 def SLURMstop(taskIDs):
-    taskIDs = taskIDs.replace(";", ",")
-    os.system(f"scancel -j ${taskIDs}")
+    taskIDs = " ".join(SLURMjobs([taskIDs]))
+    if taskIDs != "":
+        os.system(f"scancel {taskIDs}")
+
+
+def PACKscript(scripts, counter, shared):
+    # runner of one SLURM job for several directories; shared=False - every
+    # script is claimed by one rank (`counter` under `flock`), shared=True - every
+    # rank runs all scripts, starting from its own one (scripts are work queues)
+    items = " ".join(scripts)
+    if shared:
+        loop = """first=$(( (${SLURM_ARRAY_TASK_ID:-0} * ${SLURM_NTASKS:-1} + ${SLURM_PROCID:-0}) % ${#ITEMS[@]} ))
+for i in `seq 0 $(( ${#ITEMS[@]} - 1 ))`
+do
+    run_item ${ITEMS[$(( (first + i) % ${#ITEMS[@]} ))]}
+done"""
+    else:
+        loop = f"""claim_item() {{
+    (
+        flock 9
+        n=$(cat {counter})
+        echo $((n + 1)) > {counter}
+        echo $n
+    ) 9>> {counter}.lock
+}}
+#
+while n=$(claim_item) && [ $n -lt ${{#ITEMS[@]}} ]
+do
+    run_item ${{ITEMS[$n]}}
+done"""
+    return f"""#!/usr/bin/env bash
+
+JOB=${{SLURM_ARRAY_JOB_ID:-$SLURM_JOB_ID}}
+ITEMS=({items})
+#
+run_item() {{
+    # $1 - script of a directory; output and exit code go to <script>.log and <script>.exit,
+    # the directory is skipped or stopped if `<directory>/pack-$JOB.cancel` appears (`--remove`)
+    local dir=$(dirname $1)
+    local name=${{1%.sh}}
+    if [ -e $dir/pack-$JOB.cancel ]; then
+        return
+    fi
+    setsid bash $1 >> $name.log 2>&1 &
+    local pid=$!
+    while kill -0 $pid 2> /dev/null
+    do
+        if [ -e $dir/pack-$JOB.cancel ]; then
+            kill -- -$pid
+        fi
+        sleep 10
+    done
+    wait $pid
+    echo $? > $name.exit
+}}
+#
+{loop}
+"""
+
+
+def PACKwait(taskIDs, script, status):
+    # status of one directory of a finished pack job
+    if status == "Waiting":
+        return status
+    name = os.path.splitext(script)[0]
+    if os.path.exists(f"{name}.exit"):
+        code = open(f"{name}.exit").read().strip()
+        if code == "0":
+            return "Done"
+        print(f"`bash {script}` in {taskIDs} is finished with exit code {code}, see {name}.log")
+        return "Failed"
+    if status == "Done":
+        print(f"`bash {script}` was not run by {taskIDs}")
+        return "Failed"
+    return status
+
+
+def LOCALrun(script):
+    # detached process that outlives the orchestrator; its exit code is
+    # written to `<script>.exit`, its output to `<script>.log`
+    name = os.path.splitext(script)[0]
+    if os.path.exists(f"{name}.exit"):
+        os.remove(f"{name}.exit")
+    process = subprocess.Popen(f"bash {script} > {name}.log 2>&1; echo $? > {name}.exit", shell=True,
+                               stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+    return f"local:{socket.gethostname()}:{process.pid}"
+
+
+def LOCALpid(job):
+    # PID of `local:<host>:<pid>` if it is started on this host, None otherwise;
+    # `local:<pid>` of older databases is taken as a local one
+    host, _, pid = job[6:].rpartition(":")
+    if host not in ("", socket.gethostname()):
+        return None
+    return int(pid)
+
+
+def LOCALalive(pid, script):
+    try:
+        # the command line is empty while a just started process is replacing its image
+        cmdline = open(f"/proc/{pid}/cmdline").read()
+        return cmdline == "" or script in cmdline
+    except FileNotFoundError:
+        return False
+    except OSError:
+        pass
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def LOCALwait(taskIDs, script):
+    name = os.path.splitext(script)[0]
+    if os.path.exists(f"{name}.exit"):
+        code = open(f"{name}.exit").read().strip()
+        if code == "":
+            return "Waiting"
+        if code != "0":
+            print(f"`bash {script}` is finished with exit code {code}, see {name}.log")
+            return "Failed"
+        return "Done"
+    for job in taskIDs.split(";"):
+        if not job.startswith("local:"):
+            continue
+        # processes of other hosts can not be checked, they are waited for until `.exit` appears
+        pid = LOCALpid(job)
+        if pid == None or LOCALalive(pid, script):
+            return "Waiting"
+    print(f"`bash {script}` is killed, see {name}.log")
+    return "Failed"
+
+
+def LOCALstop(taskIDs):
+    for job in taskIDs.split(";"):
+        if not job.startswith("local:"):
+            continue
+        pid = LOCALpid(job)
+        if pid == None:
+            print(f"{job} is started on another host and can not be stopped from here")
+            continue
+        try:
+            os.killpg(pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+
+# FEP states: directory, mdp file, topology
+FEP_STATES = (("stateA_water", "tiA.mdp", "top_water.top"),
+              ("stateB_water", "tiB.mdp", "top_water.top"),
+              ("stateA_protein", "tiA.mdp", "topol.top"),
+              ("stateB_protein", "tiB.mdp", "topol.top"))
+
+
+def frame_order(frames):
+    # 0, 64, 32, 96, 16, ... - every prefix is spread over the whole trajectory
+    bits = max(1, (frames - 1).bit_length())
+    return sorted(range(frames), key=lambda i: int(f"{i:0{bits}b}"[::-1], 2))
+
+
+def GROMPPframe(maxwarn):
+    # bash function building tpr of one frame; the output is kept only on failure
+    return f"""grompp_frame() {{
+    # $1 - state, $2 - mdp, $3 - topology, $4 - frame
+    local out
+    out=$(gmx_mpi grompp -f mdp/$2 -p $3 -c $1/frame$4.gro -o $1/tpr$4.tpr -po $1/mdout$4.mdp -maxwarn {maxwarn} 2>&1)
+    local code=$?
+    rm -f $1/mdout$4.mdp
+    if [ $code -ne 0 ] || [ ! -s $1/tpr$4.tpr ]; then
+        echo "$out" > $1/grompp$4.log
+        echo "$1 $4" >> failed_frames.txt
+        return 1
+    fi
+}}"""
+
+
+def tail(filename, size=4096):
+    with open(filename, "rb") as f:
+        f.seek(max(0, os.fstat(f.fileno()).st_size - size))
+        return f.read().decode("ascii", errors="ignore")
+
+
+def ns_per_day(filename):
+    # `Performance:  ns/day  hour/ns` at the end of a mdrun log
+    for line in tail(filename).split("\n"):
+        if line.startswith("Performance:"):
+            try:
+                return float(line.split()[1])
+            except (IndexError, ValueError):
+                return None
+    return None
+
+
+def percentiles(values):
+    # number, p50, p90, p99 and maximum (nearest rank)
+    if values == []:
+        return f"{0:>6} ; {'':>8} ; {'':>8} ; {'':>8} ; {'':>8}"
+    values = sorted(values)
+    p50, p90, p99 = (values[min(len(values) - 1, int(q * len(values)))] for q in (0.5, 0.9, 0.99))
+    return f"{len(values):>6} ; {p50:>8.2f} ; {p90:>8.2f} ; {p99:>8.2f} ; {values[-1]:>8.2f}"
 
 
 class Task:
@@ -118,42 +739,106 @@ class Task:
         self.path = self.root + "/" + self.task
         self.maxwarn = 20
         self.omp_threads = 6
+        self.frames = 100  # number of FEP frames per state
+        self.script = None  # bash script of the stage
+        self.slurm = None  # SLURM script of the stage
+        self.array = None
+        self.executor = "inline"  # for local stages: inline/local/slurm
+        self.recoverable = False  # failed jobs are checked and partially resubmitted
+        self.resumable = False  # jobs stopped by the wall time are continued from checkpoints
+        self.time = "48:00:00"  # wall time of SLURM jobs
+        self.layout = dict(LAYOUT)
+        self.packable = False  # may be submitted with other directories in one job (`--pack`)
+        self.partition = None  # partition chosen by the scheduler instead of the one of the script
+        self.cached = ()  # states taken from the cache of water legs, they are skipped by the stage
+        self.tuned = []  # benchmarked (atoms, ranks, threads, npme) of the stage, see `--tune`
+        self.chain = False  # submitted as a part of a chain, see `FEPdb.submit_chain`
 
     def prepare(self):
         self.NI("prepare")
 
+    def states(self):
+        # FEP states computed by the stage
+        return [fep for fep in FEP_STATES if fep[0] not in self.cached]
+
+    def submit(self, dependency=None):
+        return SLURMbatch(self.slurm, array=self.array, dependency=dependency, partition=self.partition, chain=self.chain)
+
+    def submit_pack(self, tasks, name):
+        # one job `name.sh` for this stage of all `tasks`, see `PACKscript`
+        self.NI("submit_pack")
+        return "ERROR_SLURM"
+
     def run(self):
         self.NI("run")
         taskIDs = ""  # separator - `;`; error in SLURM - "SLURM_ERROR"
         return taskIDs
 
-    def wait(self, taskIDs):
+    def wait(self, taskIDs, states=None):
         self.NI("wait")
-        status = "Done"  # Done/Waiting
+        status = "Done"  # Done/Waiting/Failed/Timeout
         return status
 
     def check(self):
         self.NI("check")
-        status = "PASS"  # PASS/FAIL
+        status = "PASS"  # PASS/FAIL/INCOMPLETE
         return status
 
+    def logs(self):
+        # mdrun logs of the stage, see `FEPdb.record_metrics`
+        return []
+
+    def check_files(self, files):
+        missing = [name for name in files
+                   if not os.path.exists(f"{self.path}/{name}") or os.path.getsize(f"{self.path}/{name}") == 0]
+        if missing != []:
+            print(f"'{self.task}': " + ", ".join(missing[:10]) +
+                  (f" and {len(missing) - 10} more files are" if len(missing) > 10 else " are") + " missing or empty")
+            return "FAIL"
+        return "PASS"
+
+    def stopped(self):
+        # the failed job of a chain is stopped by the wall time, see `MD.prepare`
+        return False
+
     def NI(self, function):
         print(
             f"Function '{function}' in not implemented for stage '{self.task}'!")
 
 
-class MDPreparation(Task):
+class LocalTask(Task):
+    # stages that do not need SLURM by themselves
+    def run(self):
+        if self.executor == "slurm":
+            return self.submit()
+        if self.executor == "local":
+            return LOCALrun(self.script)
+        os.system(f"bash {self.script}")
+        return ""
+
+    def wait(self, taskIDs, states=None):
+        if taskIDs == "":
+            return "Done"
+        if taskIDs.startswith("local:"):
+            return LOCALwait(taskIDs, self.script)
+        # submitted to SLURM by `slurm` executor or as a part of a chain
+        return SLURMwait(taskIDs, states)
+
+
+class MDPreparation(LocalTask):
     def __init__(self, task, root):
         super().__init__(task, root)
+        self.script = f"{self.path}/MD_preparation.sh"
+        self.slurm = f"{self.path}/slurm-MD_preparation.sh"
 
     def prepare(self):
-        # create directories
-        os.mkdir(f"{self.path}/stateA_water")
-        os.mkdir(f"{self.path}/stateB_water")
-        os.mkdir(f"{self.path}/stateA_protein")
-        os.mkdir(f"{self.path}/stateB_protein")
-        os.mkdir(f"{self.path}/result_water")
-        os.mkdir(f"{self.path}/result_protein")
+        # create directories; prepare may be repeated if the pass was interrupted
+        os.makedirs(f"{self.path}/stateA_water", exist_ok=True)
+        os.makedirs(f"{self.path}/stateB_water", exist_ok=True)
+        os.makedirs(f"{self.path}/stateA_protein", exist_ok=True)
+        os.makedirs(f"{self.path}/stateB_protein", exist_ok=True)
+        os.makedirs(f"{self.path}/result_water", exist_ok=True)
+        os.makedirs(f"{self.path}/result_protein", exist_ok=True)
 
         command = f"""#!/usr/bin/env bash
 
@@ -193,92 +878,390 @@ gmx_mpi grompp -f mdp/eqB.mdp -c stateB_protein/emout.gro -o stateB_protein/eq.t
 #
 popd
 """
-        open(f"{self.path}/MD_preparation.sh", "w").write(command)
+        if self.cached != ():
+            # water legs (and the changed top_water.top) are taken from the cache
+            command = "\n".join(line for line in command.split("\n") if "_water" not in line)
+        open(self.script, "w").write(command)
+        open(self.slurm, "w").write(SLURMscript(self.script,
+                                                nodes=1, ntasks=1, ntasks_per_node=1, jobname=f"MDprep-{self.task}", partition=self.layout["partition"], cores_per_node=self.layout["cores_per_node"]))
 
-    def run(self):
-        os.system(f"bash {self.path}/MD_preparation.sh")
-        return ""
+    def check(self):
+        return self.check_files([f"{state}/eq.tpr" for state, _, _ in FEP_STATES])
 
-    def wait(self, taskIDs):
-        return "Done"
+
+def gro_atoms(filename):
+    # number of atoms from the second line of a .gro file, None if unknown
+    try:
+        with open(filename) as f:
+            f.readline()
+            return int(f.readline())
+    except (OSError, ValueError):
+        return None
+
+
+def split_cores(weights, cores):
+    # at least one core for everyone, the rest proportionally to weights
+    cores = max(cores, len(weights))
+    shares = [(cores - len(weights)) * weight / sum(weights) for weight in weights]
+    result = [1 + int(share) for share in shares]
+    for i in sorted(range(len(weights)), key=lambda i: int(shares[i]) - shares[i])[:cores - sum(result)]:
+        result[i] += 1
+    return result
+
+
+# hours before the wall time below which MD.sh does not start the next state
+MAXH_MIN = 0.05
 
 
 class MD(Task):
     def __init__(self, task, root):
         super().__init__(task, root)
-        self.omp_threads = 24
+        self.script = f"{self.path}/MD.sh"
+        self.slurm = f"{self.path}/slurm-MD.sh"
+        self.resumable = True
+        self.missing = []  # unfinished states, see `check`
+        self.mode = "sequential"  # sequential/packed/multidir
+        self.packable = True  # not for `multidir`, which starts MPI ranks by itself
+
+    def leg_layouts(self):
+        # tuned (ranks, threads, npme) of the legs by their sizes, None - not benchmarked
+        return {state: best_layout(self.tuned, gro_atoms(f"{self.path}/{state}/emout.gro"))
+                for state, _, _ in self.states()}
+
+    def legs(self):
+        # run_state calls for the four legs, see `prepare`
+        states = [state for state, _, _ in self.states()]
+        if self.mode == "sequential":
+            runs = []
+            for state, tuned in self.leg_layouts().items():
+                if tuned == None:
+                    runs.append(f"run_state {state} {self.layout['md_threads']}")
+                else:
+                    # the whole node with the fastest layout of the size of the leg
+                    ranks, threads, npme = tuned
+                    runs.append(f'run_state {state} {threads} 0 {ranks} {npme}')
+            return "\n".join(f"{run} || {{ [ $? -eq 2 ] && stopped; exit 1; }}" for run in runs)
+        # legs of one node at the same time, each one pinned to its own cores;
+        # bigger systems get more cores, so that the legs finish together
+        atoms = [gro_atoms(f"{self.path}/{state}/emout.gro") for state in states]
+        if None in atoms:
+            atoms = [1] * len(states)
+        cores = split_cores(atoms, self.layout["cores_per_node"])
+        offsets = [sum(cores[:i]) for i in range(len(cores))]
+        runs = "\n".join(f"run_state {state} {threads} {offset} &"
+                         for state, threads, offset in zip(states, cores, offsets))
+        return f"""{runs}
+code=0
+for pid in $(jobs -p)
+do
+    wait $pid
+    status=$?
+    if [ $status -eq 1 ]; then
+        code=1
+    elif [ $status -eq 2 ] && [ $code -eq 0 ]; then
+        code=2
+    fi
+done
+if [ $code -eq 2 ]; then
+    stopped
+fi
+exit $code"""
 
     def prepare(self):
+        # the script may be run several times: finished states are skipped,
+        # the others are continued from `<state>/state.cpt`
+        maxh = f"""START=$(date +%s)
+maxh() {{
+    # hours left before the wall time, with a margin for writing the checkpoint
+    awk -v start=$START -v now=$(date +%s) 'BEGIN {{printf "%.3f", ({SLURMseconds(self.time)} * 0.97 - (now - start)) / 3600}}'
+}}
+rm -f MD.stopped
+stopped() {{
+    # a state is stopped by -maxh and is continued by the next job; in a chain the job fails,
+    # so that FEP preparation does not start (afterok), and MD.stopped tells it from errors
+    if [ -n "$FEP_CHAIN" ]; then
+        touch MD.stopped
+        exit 3
+    fi
+    exit 0
+}}"""
+        if self.mode == "multidir":
+            # one mdrun with a rank per leg; all legs are stopped by -maxh together
+            threads = self.layout["cores_per_node"] // len(self.states())
+            dirs = " ".join(state for state, _, _ in self.states())
+            run = f"""{maxh}
+#
+mpirun -n {len(self.states())} gmx_mpi mdrun -multidir {dirs} -deffnm eq -x traj_comp.xtc -cpi state.cpt -cpo state.cpt -maxh $(maxh) -ntomp {threads} || exit 1
+for state in {dirs}
+do
+    [ -s $state/eq.gro ] || stopped
+done"""
+            ntasks, srun = len(self.states()), False
+        else:
+            run = f"""{maxh}
+#
+run_state() {{
+    # $1 - state, $2 - OpenMP threads, $3 - first core (pinned if defined),
+    # $4 - MPI ranks and $5 - PME ranks (tuned layout, if defined)
+    # returns 0 if the state is finished, 2 if it is stopped by -maxh
+    if [ -s $1/eq.gro ]; then
+        return 0
+    fi
+    if awk -v h=$(maxh) 'BEGIN {{exit !(h < {MAXH_MIN})}}'; then
+        # too little time is left (-maxh <= 0 is no limit at all), the next job runs the state
+        touch $1/state.deferred
+        return 2
+    fi
+    rm -f $1/state.deferred
+    local pin=""
+    if [ -n "$3" ]; then
+        pin="-pin on -pinoffset $3 -pinstride 1"
+    fi
+    local ranks="-n 1" pme=""
+    if [ -n "$4" ]; then
+        ranks="-n $4 --oversubscribe --bind-to none"
+        pme="-npme $5"
+    fi
+    OMP_NUM_THREADS=$2 mpirun $ranks gmx_mpi mdrun -deffnm $1/eq -x $1/traj_comp.xtc -cpi $1/state.cpt -cpo $1/state.cpt -maxh $(maxh) -ntomp $2 $pin $pme || return 1
+    if [ ! -s $1/eq.gro ]; then
+        # the next job continues from the checkpoint
+        return 2
+    fi
+}}
+#
+{self.legs()}"""
+            threads, ntasks, srun = self.layout["md_threads"], 1, True
         command = f"""#!/usr/bin/env bash
 
 module load anaconda3/python3-5.1.0 openmpi/4.1.0 gromacs/2021
 #
-export OMP_NUM_THREADS={self.omp_threads}
+export OMP_NUM_THREADS={threads}
 #
 pushd {self.path}
 #
-mpirun -n 1 gmx_mpi mdrun -s stateA_water/eq.tpr -x stateA_water/traj_comp.xtc -ntomp {self.omp_threads}
-mpirun -n 1 gmx_mpi mdrun -s stateB_water/eq.tpr -x stateB_water/traj_comp.xtc -ntomp {self.omp_threads}
-mpirun -n 1 gmx_mpi mdrun -s stateA_protein/eq.tpr -x stateA_protein/traj_comp.xtc -ntomp {self.omp_threads}
-mpirun -n 1 gmx_mpi mdrun -s stateB_protein/eq.tpr -x stateB_protein/traj_comp.xtc -ntomp {self.omp_threads}
+{run}
 #
 popd
 """
-        open(f"{self.path}/MD.sh", "w").write(command)
-        open(f"{self.path}/slurm-MD.sh", "w").write(SLURMscript(f"{self.path}/MD.sh",
-                                                                nodes=1, ntasks=1, ntasks_per_node=1, jobname=f"MD-{self.task}"))
+        open(self.script, "w").write(command)
+        open(self.slurm, "w").write(SLURMscript(self.script,
+                                                nodes=1, ntasks=ntasks, ntasks_per_node=ntasks, jobname=f"MD-{self.task}", time=self.time, partition=self.layout["partition"], cores_per_node=self.layout["cores_per_node"], srun=srun))
 
     def run(self):
-        return SLURMbatch(f"{self.path}/slurm-MD.sh")
+        return self.submit()
+
+    def submit_pack(self, tasks, name):
+        # a node per directory
+        for task in tasks:
+            if os.path.exists(f"{task.path}/MD.exit"):
+                os.remove(f"{task.path}/MD.exit")
+        open(f"{name}.next", "w").write("0\n")
+        open(f"{name}.sh", "w").write(PACKscript([task.script for task in tasks], f"{name}.next", shared=False))
+        open(f"{name}.slurm", "w").write(SLURMscript(f"{name}.sh",
+                                                     nodes=len(tasks), ntasks=len(tasks), ntasks_per_node=1, jobname=f"MD-pack{len(tasks)}", time=self.time, partition=self.layout["partition"], cores_per_node=self.layout["cores_per_node"]))
+        return SLURMbatch(f"{name}.slurm", partition=self.partition)
+
+    def wait(self, taskIDs, states=None):
+        if taskIDs.startswith("pack:"):
+            return PACKwait(taskIDs, self.script, SLURMwait(taskIDs, states))
+        return SLURMwait(taskIDs, states)
+
+    def logs(self):
+        return [f"{self.path}/{state}/eq.log" for state, _, _ in self.states()
+                if os.path.exists(f"{self.path}/{state}/eq.log")]
+
+    def check(self):
+        self.missing = [state for state, _, _ in FEP_STATES
+                        if not os.path.exists(f"{self.path}/{state}/eq.gro")]
+        # a state is continued from its checkpoint or is not started for the lack of time
+        if any(os.path.exists(f"{self.path}/{state}/state.cpt") or os.path.exists(f"{self.path}/{state}/state.deferred")
+               for state in self.missing):
+            return "INCOMPLETE"
+        return self.check_files([f"{state}/{name}" for state, _, _ in FEP_STATES for name in ("traj_comp.xtc", "eq.gro")])
 
-    def wait(self, taskIDs):
-        return SLURMwait(taskIDs)
+    def stopped(self):
+        return os.path.exists(f"{self.path}/MD.stopped")
 
 
-class FEPPreparation(Task):
+class FEPPreparation(LocalTask):
     def __init__(self, task, root):
         super().__init__(task, root)
         self.maxwarn = 21
+        self.script = f"{self.path}/FEP_preparation.sh"
+        self.slurm = f"{self.path}/slurm-FEP_preparation.sh"
+        self.workers = 8  # parallel trjconv/grompp processes
+        self.lazy_tpr = False  # tpr files are built by FEP.sh
 
     def prepare(self):
+        # trjconv of the states and grompp of the frames run in parallel,
+        # at most `self.workers` processes at once
+        trjconv = "\n".join(
+            f"trjconv_state {state} &" for state, _, _ in self.states())
+        frames = "\n".join(
+            f"    echo {state} {mdp} {top} $i" for state, mdp, top in self.states())
+        grompp = f"""for i in `seq 0 {self.frames - 1}`
+do
+{frames}
+done | xargs -P {self.workers} -n 4 bash -c 'grompp_frame "$@"' _"""
+        if self.lazy_tpr:
+            grompp = "# tpr files are built by FEP.sh itself"
         command = f"""#!/usr/bin/env bash
 
 module load anaconda3/python3-5.1.0 openmpi/4.1.0 gromacs/2021
 #
-export OMP_NUM_THREADS={self.omp_threads}
+export OMP_NUM_THREADS=1
+export GMX_MAXBACKUP=-1
 #
 pushd {self.path}
 #
-echo 0 | gmx_mpi trjconv -s stateA_water/eq.tpr -f stateA_water/traj_comp.xtc -o stateA_water/frame.gro -b 1 -pbc mol -ur compact -sep
-echo 0 | gmx_mpi trjconv -s stateB_water/eq.tpr -f stateB_water/traj_comp.xtc -o stateB_water/frame.gro -b 1 -pbc mol -ur compact -sep
-echo 0 | gmx_mpi trjconv -s stateA_protein/eq.tpr -f stateA_protein/traj_comp.xtc -o stateA_protein/frame.gro -b 1 -pbc mol -ur compact -sep
-echo 0 | gmx_mpi trjconv -s stateB_protein/eq.tpr -f stateB_protein/traj_comp.xtc -o stateB_protein/frame.gro -b 1 -pbc mol -ur compact -sep
+rm -f failed_frames.txt
 #
-for i in `seq 0 99`
-do
-    gmx_mpi grompp -f mdp/tiA.mdp -p top_water.top -c stateA_water/frame${{i}}.gro -o stateA_water/tpr${{i}}.tpr -maxwarn {self.maxwarn}
-    gmx_mpi grompp -f mdp/tiB.mdp -p top_water.top -c stateB_water/frame${{i}}.gro -o stateB_water/tpr${{i}}.tpr -maxwarn {self.maxwarn}
-    gmx_mpi grompp -f mdp/tiA.mdp -p topol.top -c stateA_protein/frame${{i}}.gro -o stateA_protein/tpr${{i}}.tpr -maxwarn {self.maxwarn}
-    gmx_mpi grompp -f mdp/tiB.mdp -p topol.top -c stateB_protein/frame${{i}}.gro -o stateB_protein/tpr${{i}}.tpr -maxwarn {self.maxwarn}
-done
+trjconv_state() {{
+    # $1 - state
+    echo 0 | gmx_mpi trjconv -s $1/eq.tpr -f $1/traj_comp.xtc -o $1/frame.gro -b 1 -pbc mol -ur compact -sep > $1/trjconv.log 2>&1 || echo "$1 trjconv" >> failed_frames.txt
+}}
+{GROMPPframe(self.maxwarn)}
+export -f grompp_frame
+#
+{trjconv}
+wait
+#
+{grompp}
 #
 popd
+if [ -s {self.path}/failed_frames.txt ]; then
+    echo "Failed frames (state, frame):"
+    cat {self.path}/failed_frames.txt
+    exit 1
+fi
 """
-        open(f"{self.path}/FEP_preparation.sh", "w").write(command)
-
-    def run(self):
-        os.system(f"bash {self.path}/FEP_preparation.sh")
-        return ""
+        open(self.script, "w").write(command)
+        open(self.slurm, "w").write(SLURMscript(self.script,
+                                                nodes=1, ntasks=1, ntasks_per_node=1, jobname=f"FEPprep-{self.task}", partition=self.layout["partition"], cores_per_node=self.layout["cores_per_node"]))
 
-    def wait(self, taskIDs):
-        return "Done"
+    def check(self):
+        if os.path.exists(f"{self.path}/failed_frames.txt") and os.path.getsize(f"{self.path}/failed_frames.txt") > 0:
+            print(f"'{self.task}': some frames are failed, see failed_frames.txt")
+            return "FAIL"
+        files = [f"{state}/frame{frame}.gro" for state, _, _ in FEP_STATES for frame in range(self.frames)]
+        if not self.lazy_tpr:
+            files += [f"{state}/tpr{frame}.tpr" for state, _, _ in FEP_STATES for frame in range(self.frames)]
+        return self.check_files(files)
 
 
 class FEP(Task):
     def __init__(self, task, root):
         super().__init__(task, root)
+        self.maxwarn = 21
+        self.script = f"{self.path}/FEP.sh"
+        self.slurm = f"{self.path}/slurm-FEP.sh"
+        self.queue = f"{self.path}/fep_queue.txt"
+        self.recoverable = True
+        self.resumable = True
+        self.packable = True
+        self.missing = []  # (state, frame) pairs without results, see `check`
+        self.active = None  # frames run so far in adaptive mode (`--adaptive`), None - all frames
+        self.pending = None  # pairs of the queue written once the job is submitted, see `resubmit_frames`
+        self.nodes = 5
+        self.ntasks = 20
+        self.ntasks_per_node = 4
+        self.array = 5
+
+    def write_queue(self, items):
+        # shared work queue of (state, frame) pairs: every rank of every array
+        # job takes the next line under `flock` until the queue is exhausted;
+        # protein states go first as the longest ones
+        items = sorted(items, key=lambda item: ("protein" not in item[0], item[1]))
+        with open(self.queue, "w") as queue:
+            for state, frame in items:
+                _, mdp, top = [fep for fep in FEP_STATES if fep[0] == state][0]
+                queue.write(f"{state} {mdp} {top} {frame}\n")
+        open(f"{self.path}/fep_queue.next", "w").write("0\n")
+        if os.path.exists(f"{self.path}/fep_queue.failed"):
+            os.remove(f"{self.path}/fep_queue.failed")
+
+    def queue_size(self):
+        if self.pending != None:
+            return len(self.pending)
+        if not os.path.exists(self.queue):
+            return 0
+        return len(open(self.queue).read().split("\n")) - 1
+
+    def tune(self):
+        # frames per node and their OpenMP threads of the benchmark closest to
+        # the biggest system of the queue, see `--tune`
+        tuned = best_layout(self.tuned, max([atoms for atoms in (gro_atoms(f"{self.path}/{state}/emout.gro")
+                                                                 for state, _, _ in self.states()) if atoms != None], default=None))
+        if tuned != None:
+            self.ntasks_per_node, self.omp_threads, _ = tuned
+            self.ntasks = self.nodes * self.ntasks_per_node
+
+    def submit(self, dependency=None):
+        # on average, every rank takes all four states of one frame
+        self.tune()
+        self.array = max(1, -(-self.queue_size() // (len(FEP_STATES) * self.ntasks)))
+        return super().submit(dependency)
+
+    def submit_pack(self, tasks, name):
+        # ranks of the array go through the queues of all directories
+        self.tune()
+        size = sum(task.queue_size() for task in tasks)
+        self.array = max(1, -(-size // (len(FEP_STATES) * self.ntasks)))
+        open(f"{name}.sh", "w").write(PACKscript([task.script for task in tasks], None, shared=True))
+        open(f"{name}.slurm", "w").write(SLURMscript(f"{name}.sh",
+                                                     nodes=self.nodes, ntasks=self.ntasks, ntasks_per_node=self.ntasks_per_node, jobname=f"FEP-pack{len(tasks)}", time=self.time, partition=self.layout["partition"], cores_per_node=self.layout["cores_per_node"]))
+        return SLURMbatch(f"{name}.slurm", array=self.array, partition=self.partition)
+
+    def frame_done(self, state, frame, files):
+        # dhdl is written and mdrun has reached its end
+        if f"dhdl{frame}.xvg" not in files or f"dhdl{frame}.log_gmx" not in files:
+            return False
+        if os.path.getsize(f"{self.path}/{state}/dhdl{frame}.xvg") == 0:
+            return False
+        end = tail(f"{self.path}/{state}/dhdl{frame}.log_gmx")
+        return "Performance:" in end or "Finished mdrun" in end
+
+    def frame_list(self):
+        return list(range(self.frames)) if self.active == None else self.active
+
+    def started_frames(self):
+        # (state, frame) pairs reached by the jobs since the queue was written:
+        # mdrun has started (its output is newer than the queue) or the frame has failed
+        if not os.path.exists(self.queue):
+            return set()
+        since = os.path.getmtime(self.queue)
+        started = set()
+        if os.path.exists(f"{self.path}/fep_queue.failed"):
+            for line in open(f"{self.path}/fep_queue.failed"):
+                item = line.split()
+                if len(item) == 4:
+                    started.add((item[0], int(item[3])))
+        for state, frame in self.missing:
+            log = f"{self.path}/{state}/dhdl{frame}.log_gmx"
+            if os.path.exists(log) and os.path.getmtime(log) >= since:
+                started.add((state, frame))
+        return started
+
+    def logs(self):
+        return [log for state, _, _ in self.states() for log in glob.glob(f"{self.path}/{state}/dhdl*.log_gmx")]
+
+    def done_frames(self, state):
+        files = set(os.listdir(f"{self.path}/{state}")) if os.path.isdir(f"{self.path}/{state}") else set()
+        return [frame for frame in range(self.frames) if self.frame_done(state, frame, files)]
+
+    def check(self):
+        self.missing = []
+        for state, _, _ in FEP_STATES:
+            done = set(self.done_frames(state))
+            self.missing += [(state, frame) for frame in self.frame_list() if frame not in done]
+        if self.missing != []:
+            return "INCOMPLETE"
+        return "PASS"
 
     def prepare(self):
+        self.tune()
+        self.write_queue([(state, frame) for frame in self.frame_list()
+                          for state, _, _ in self.states()])
         command = f"""#!/usr/bin/env bash
 
 module load anaconda3/python3-5.1.0 openmpi/4.1.0 gromacs/2021
@@ -288,29 +1271,126 @@ export GMX_MAXBACKUP=-1
 #
 pushd {self.path}
 #
-let "JOBinternal=${{SLURM_ARRAY_TASK_ID}}*${{SLURM_NTASKS}}+${{SLURM_PROCID}}"
+{GROMPPframe(self.maxwarn)}
 #
-mpirun -n 1 gmx_mpi mdrun -v -s stateA_water/tpr${{JOBinternal}}.tpr -dhdl stateA_water/dhdl${{JOBinternal}}.xvg -ntomp {self.omp_threads} 2>&1 | tee stateA_water/dhdl${{JOBinternal}}.log_gmx
-mpirun -n 1 gmx_mpi mdrun -v -s stateB_water/tpr${{JOBinternal}}.tpr -dhdl stateB_water/dhdl${{JOBinternal}}.xvg -ntomp {self.omp_threads} 2>&1 | tee stateB_water/dhdl${{JOBinternal}}.log_gmx
-mpirun -n 1 gmx_mpi mdrun -v -s stateA_protein/tpr${{JOBinternal}}.tpr -dhdl stateA_protein/dhdl${{JOBinternal}}.xvg -ntomp {self.omp_threads} 2>&1 | tee stateA_protein/dhdl${{JOBinternal}}.log_gmx
-mpirun -n 1 gmx_mpi mdrun -v -s stateB_protein/tpr${{JOBinternal}}.tpr -dhdl stateB_protein/dhdl${{JOBinternal}}.xvg -ntomp {self.omp_threads} 2>&1 | tee stateB_protein/dhdl${{JOBinternal}}.log_gmx
+run_frame() {{
+    # $1 - state, $2 - mdp, $3 - topology, $4 - frame
+    if [ ! -s $1/tpr$4.tpr ]; then
+        # tpr is not built by FEP preparation (`--lazy_tpr`)
+        grompp_frame $1 $2 $3 $4 || return 1
+    fi
+{self.mdrun_frame()}
+}}
+#
+claim_item() {{
+    # prints the next line of the queue, nothing if the queue is exhausted
+    (
+        flock 9
+        n=$(cat fep_queue.next)
+        echo $((n + 1)) > fep_queue.next
+        sed -n "$((n + 1))p" fep_queue.txt
+    ) 9>> fep_queue.lock
+}}
+#
+while item=$(claim_item) && [ -n "$item" ]
+do
+    run_frame $item || echo "$item" >> fep_queue.failed
+done
 #
 popd
+# in a chain, result processing must not start (afterok) with failed frames
+if [ -n "$FEP_CHAIN" ] && [ -s {self.path}/fep_queue.failed ]; then
+    exit 1
+fi
 """
-        open(f"{self.path}/FEP.sh", "w").write(command)
-        open(f"{self.path}/slurm-FEP.sh", "w").write(SLURMscript(f"{self.path}/FEP.sh",
-                                                                 nodes=5, ntasks=20, ntasks_per_node=4, jobname=f"FEP-{self.task}"))
+        open(self.script, "w").write(command)
+        open(self.slurm, "w").write(SLURMscript(self.script,
+                                                nodes=self.nodes, ntasks=self.ntasks, ntasks_per_node=self.ntasks_per_node, jobname=f"FEP-{self.task}", partition=self.layout["partition"], cores_per_node=self.layout["cores_per_node"], time=self.time))
+
+    def mdrun_frame(self):
+        # mdrun part of `run_frame` in FEP.sh
+        if self.layout["scratch"] == "":
+            return f"""    # a frame stopped by the wall time is continued from its checkpoint
+    mpirun -n 1 gmx_mpi mdrun -v -deffnm $1/dhdl$4 -s $1/tpr$4.tpr -dhdl $1/dhdl$4.xvg -cpi $1/dhdl$4.cpt -ntomp {self.omp_threads} 2>&1 | tee $1/dhdl$4.log_gmx
+    local code=${{PIPESTATUS[0]}}
+    if [ $code -eq 0 ]; then
+        # only dhdl is needed
+        rm -f $1/dhdl$4.cpt $1/dhdl$4_prev.cpt $1/dhdl$4.log $1/dhdl$4.edr $1/dhdl$4.gro $1/dhdl$4.trr $1/dhdl$4.xtc
+    fi
+    return $code"""
+        # all outputs but the mdrun output go to node-local scratch, only dhdl comes back
+        # (atomically, so that it is never seen half-copied); a frame stopped by the wall
+        # time starts anew, as its checkpoint is lost with the scratch
+        return f"""    local work
+    work=$(mktemp -d {self.layout["scratch"]}/fep.XXXXXX) || return 1
+    mpirun -n 1 gmx_mpi mdrun -v -deffnm $work/dhdl$4 -s $1/tpr$4.tpr -dhdl $work/dhdl$4.xvg -ntomp {self.omp_threads} 2>&1 | tee $1/dhdl$4.log_gmx
+    local code=${{PIPESTATUS[0]}}
+    if [ $code -eq 0 ]; then
+        cp $work/dhdl$4.xvg $1/dhdl$4.xvg.part && mv $1/dhdl$4.xvg.part $1/dhdl$4.xvg || code=1
+    fi
+    rm -rf $work
+    return $code"""
 
     def run(self):
-        return SLURMbatch(f"{self.path}/slurm-FEP.sh", array=5)
-
-    def wait(self, taskIDs):
-        return SLURMwait(taskIDs)
-
-
-class ResultProcessing(Task):
+        return self.submit()
+
+    def stream(self):
+        # works of the frames finished so far go to works.json of the states while
+        # the array is running, so that Result processing only has to estimate dG
+        try:
+            import dhdl_analysis
+        except ImportError:
+            return
+        for stateA, stateB in dhdl_analysis.LEGS.values():
+            for state, lambda0 in ((stateA, 0), (stateB, 1)):
+                if not os.path.isdir(f"{self.path}/{state}"):
+                    continue
+                try:
+                    dhdl_analysis.cached_works(f"{self.path}/{state}", lambda0)
+                except (OSError, ValueError) as e:
+                    # Result processing reads the files again and reports the error
+                    print(f"'{self.path}/{state}': {e}")
+
+    def wait(self, taskIDs, states=None):
+        result = SLURMwait(taskIDs, states)
+        self.stream()
+        return result
+
+
+class ResultProcessing(LocalTask):
     def __init__(self, task, root):
         super().__init__(task, root)
+        self.script = f"{self.path}/Result_processing.sh"
+        self.slurm = f"{self.path}/slurm-Result_processing.sh"
+        self.compact = False  # per-frame files are packed or removed after the analysis (`--compact`)
+
+    def compaction(self):
+        # dhdl_analysis.py reads the archives (works of the packed files are usually in works.json already)
+        if not self.compact:
+            return ""
+        states = " ".join(state for state, _, _ in FEP_STATES)
+        return f"""
+pack_state() {{
+    # $1 - state; files of an earlier archive are kept unless they are written again
+    local files
+    if [ -s $1/dhdl.tar.gz ]; then
+        tar -xzf $1/dhdl.tar.gz -C $1 --skip-old-files || return 1
+    fi
+    files=$(cd $1 && find . -maxdepth 1 \\( -name 'dhdl*.xvg' -o -name 'dhdl*.log_gmx' \\) -printf '%f\\n')
+    if [ -z "$files" ]; then
+        return 0
+    fi
+    tar -czf $1/dhdl.tar.gz.part -C $1 $files && mv $1/dhdl.tar.gz.part $1/dhdl.tar.gz || return 1
+    (cd $1 && rm -f $files)
+    find $1 -maxdepth 1 \\( -name 'frame*.gro' -o -name 'tpr*.tpr' -o -name '#*#' \\) -delete
+}}
+#
+for state in {states}
+do
+    if [ -d $state ]; then
+        pack_state $state || exit 1
+    fi
+done"""
 
     def prepare(self):
         command = f"""#!/usr/bin/env bash
@@ -321,20 +1401,126 @@ export OMP_NUM_THREADS={self.omp_threads}
 #
 pushd {self.path}
 #
-{self.root}/analyze_dhdl.py -fA stateA_water/dhdl*xvg   -fB stateB_water/dhdl*xvg   -o result_water/results_water.txt     -t 298
-{self.root}/analyze_dhdl.py -fA stateA_protein/dhdl*xvg -fB stateB_protein/dhdl*xvg -o result_protein/results_protein.txt -t 298
-{self.root}/extract.py --protein result_protein/results_protein.txt --water result_water/results_water.txt --output {self.path}/../result_{self.task}.csv --protein_name {self.task}
-#
+{self.root}/dhdl_analysis.py --path {self.path} --output {self.path}/../result_{self.task}.csv --protein_name {self.task} -t 298 || exit 1
+#{self.compaction()}
 popd
 """
-        open(f"{self.path}/Result_processing.sh", "w").write(command)
+        open(self.script, "w").write(command)
+        open(self.slurm, "w").write(SLURMscript(self.script,
+                                                nodes=1, ntasks=1, ntasks_per_node=1, jobname=f"Result-{self.task}", partition=self.layout["partition"], cores_per_node=self.layout["cores_per_node"]))
 
-    def run(self):
-        os.system(f"bash {self.path}/Result_processing.sh")
-        return ""
+    def check(self):
+        return self.check_files([f"../result_{self.task}.csv"])
+
+
+WATER_STATES = ("stateA_water", "stateB_water")
+
+
+def topology_files(path, topology, files=None):
+    # the topology and all local files included by it
+    files = [] if files == None else files
+    filename = os.path.normpath(f"{path}/{topology}")
+    if filename in files or not os.path.isfile(filename):
+        return files
+    files.append(filename)
+    for line in open(filename, errors="ignore"):
+        if line.startswith("#include") and '"' in line:
+            topology_files(os.path.dirname(filename), line.split('"')[1], files)
+    return files
+
+
+def water_key(path, frames):
+    # hash of everything the water legs depend on: the ligand pair, its topology
+    # with included files and the mdp files; must be taken before MD preparation,
+    # which changes top_water.top
+    files = [f"{path}/merged.pdb"] + topology_files(path, "top_water.top") + sorted(glob.glob(f"{path}/mdp/*.mdp"))
+    key = hashlib.sha256(f"frames={frames}\n".encode())
+    for filename in files:
+        if not os.path.isfile(filename):
+            return None
+        key.update(os.path.relpath(filename, path).encode() + b"\0")
+        key.update(open(filename, "rb").read())
+    return key.hexdigest()
+
+
+def copy_tree(source, target):
+    # `shutil.copytree` into an existing directory (`dirs_exist_ok` needs Python 3.8)
+    for root, _, names in os.walk(source):
+        directory = os.path.join(target, os.path.relpath(root, source))
+        os.makedirs(directory, exist_ok=True)
+        for name in names:
+            shutil.copy2(os.path.join(root, name), os.path.join(directory, name))
+
+
+class WaterCache:
+    # outputs of the water legs after every stage (`<key>/<stage>/`), copied to and from directories;
+    # least recently used entries are removed when the cache is larger than `size` bytes
+    def __init__(self, directory, size):
+        self.directory = directory
+        self.size = size
+        os.makedirs(directory, exist_ok=True)
+
+    def restore(self, path, key, stage):
+        entry = f"{self.directory}/{key}/{stage}"
+        if not os.path.exists(f"{entry}/size"):
+            return False
+        for name in os.listdir(entry):
+            if name in WATER_STATES:
+                copy_tree(f"{entry}/{name}", f"{path}/{name}")
+            elif name == "top_water.top":
+                shutil.copy2(f"{entry}/{name}", f"{path}/{name}")
+        os.utime(f"{entry}/size")
+        return True
+
+    def store(self, path, key, stage):
+        entry = f"{self.directory}/{key}/{stage}"
+        if os.path.exists(entry):
+            return
+        tmp = f"{entry}.tmp{os.getpid()}"
+        for name in WATER_STATES:
+            shutil.copytree(f"{path}/{name}", f"{tmp}/{name}")
+        shutil.copy2(f"{path}/top_water.top", f"{tmp}/top_water.top")
+        size = sum(os.path.getsize(f"{root}/{name}") for root, _, names in os.walk(tmp) for name in names)
+        open(f"{tmp}/size", "w").write(f"{size}\n")
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            # stored by another controller
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for entry in glob.glob(f"{self.directory}/*/*/size"):
+            try:
+                entries.append((os.path.getmtime(entry), int(open(entry).read()), os.path.dirname(entry)))
+            except (OSError, ValueError):
+                continue
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+
+def filesystem(path):
+    # type of the filesystem with `path`, "" if unknown
+    path = os.path.realpath(path)
+    fstype, mountpoint = "", ""
+    try:
+        mounts = open("/proc/mounts").read().split("\n")
+    except OSError:
+        return fstype
+    for mount in mounts:
+        fields = mount.split()
+        if len(fields) < 3:
+            continue
+        point = fields[1].replace("\\040", " ")
+        if (path == point or path.startswith(point.rstrip("/") + "/")) and len(point) >= len(mountpoint):
+            fstype, mountpoint = fields[2], point
+    return fstype
 
-    def wait(self, taskIDs):
-        return "Done"
 
 class FEPdb:
     STATUS = {0: "Not started",
@@ -354,18 +1540,64 @@ class FEPdb:
              3: "FEP preparation",
              4: "FEP",
              5: "Result processing"}
+    TASK = {1: MDPreparation,
+            2: MD,
+            3: FEPPreparation,
+            4: FEP,
+            5: ResultProcessing}
+    # WAL needs shared memory between processes, which network filesystems do not provide
+    NETWORK_FS = ("nfs", "nfs4", "lustre", "gpfs", "beegfs", "cifs", "smb3", "smbfs",
+                  "ceph", "glusterfs", "fuse.glusterfs", "fuse.sshfs", "9p")
     db = None
     run = None
 
-    def __init__(self, dbfile):
+    def __init__(self, dbfile, executor="local", workers=4, prep_workers=8, lazy_tpr=False, journal="auto",
+                 lease_batch=500, lease_ttl=3600, max_attempts=3, md_time="48:00:00", fep_time="48:00:00",
+                 md_mode="sequential", layout=None, pack=1, stage_limits=None, cache_dir=None, cache_size=500,
+                 adaptive=0, target_se=0.5, max_frames=None, compact=False):
         self.root, _ = os.path.split(os.path.abspath(dbfile))
-        self.db = sqlite3.connect(dbfile)
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.lease_batch = lease_batch
+        self.lease_ttl = lease_ttl
+        self.pending = []
+        self.batch = ""  # lease owner of the current batch
+        self.executor = executor
+        self.workers = workers
+        self.prep_workers = prep_workers
+        self.lazy_tpr = lazy_tpr
+        self.max_attempts = max_attempts
+        self.md_time = md_time
+        self.fep_time = fep_time
+        self.md_mode = md_mode
+        self.layout = dict(LAYOUT) if layout == None else layout
+        self.pack = pack
+        self.stage_limits = {} if stage_limits == None else stage_limits
+        # partitions in order of preference with their limits of jobs in flight
+        self.partitions = self.layout["partitions"] if self.layout["partitions"] != {} else {self.layout["partition"]: None}
+        self.cache = None if cache_dir == None else WaterCache(cache_dir, cache_size * 1024 ** 3)
+        self.adaptive = adaptive
+        self.target_se = target_se
+        self.max_frames = max_frames
+        self.compact = compact
+        self.jobs_stage = {}  # jobs in flight, see `count_jobs`
+        self.jobs_partition = {}
+        # every write transaction takes the write lock at once (BEGIN IMMEDIATE)
+        self.db = sqlite3.connect(dbfile, timeout=600, isolation_level="IMMEDIATE")
         self.run = self.db.cursor()
-        if not self.FEP_table_exists():
-            self.FEP_table_create()
+        self.FEP_journal(journal)
+        self.FEP_table_migrate()
+        self.tuned = self.collect_tuning()
         if self.FEP_table_exists():
             print("Starting...")
 
+    def FEP_journal(self, journal):
+        if journal == "auto":
+            journal = "delete" if filesystem(self.root) in self.NETWORK_FS else "wal"
+        mode, = self.run.execute(f"PRAGMA journal_mode = {journal}").fetchone()
+        if mode.lower() == "wal":
+            # with WAL, commits do not fsync the database file
+            self.run.execute("PRAGMA synchronous = NORMAL")
+
     def FEP_table_exists(self):
         FEP_table = self.run.execute(
             "SELECT name FROM sqlite_master WHERE type='table' AND name='tasks_control'").fetchall()
@@ -373,21 +1605,246 @@ class FEPdb:
             return True
         return False
 
-    def FEP_table_create(self):
-        self.run.execute(
-            "CREATE TABLE tasks_control (directory text, stage integer, status integer, taskID text)")
-        self.db.commit()
+    def migration(self, version):
+        # a step is taken under the write lock and only if the schema is still older
+        # than `version`: concurrent controllers must not take the same step twice
+        self.run.execute("BEGIN IMMEDIATE")
+        current, = self.run.execute("PRAGMA user_version").fetchone()
+        if current >= version:
+            self.db.commit()
+            return False
+        return True
+
+    def FEP_table_migrate(self):
+        # schema version is kept in `PRAGMA user_version`
+        version, = self.run.execute("PRAGMA user_version").fetchone()
+        if version < 1 and self.migration(1):
+            # directory is the primary key, (status, stage) is indexed;
+            # chain - job IDs of the next stages submitted with `--chain`, separator - `;`
+            columns = [column[1] for column in self.run.execute(
+                "PRAGMA table_info(tasks_control)").fetchall()]
+            self.run.execute(
+                "CREATE TABLE tasks_control_v1 (directory text PRIMARY KEY, stage integer, status integer, taskID text DEFAULT '', chain text DEFAULT '')")
+            if columns != []:
+                chain = "COALESCE(chain, '')" if "chain" in columns else "''"
+                self.run.execute(
+                    f"INSERT OR REPLACE INTO tasks_control_v1 SELECT directory, stage, status, taskID, {chain} FROM tasks_control")
+                self.run.execute("DROP TABLE tasks_control")
+            self.run.execute(
+                "ALTER TABLE tasks_control_v1 RENAME TO tasks_control")
+            self.run.execute(
+                "CREATE INDEX tasks_status_stage ON tasks_control (status, stage)")
+            self.run.execute("PRAGMA user_version = 1")
+            self.db.commit()
+        if version < 2 and self.migration(2):
+            # lease of a task by a controller (`host:pid:batch`) until `lease_expiry` (Unix time)
+            self.run.execute(
+                "ALTER TABLE tasks_control ADD COLUMN lease_owner text DEFAULT ''")
+            self.run.execute(
+                "ALTER TABLE tasks_control ADD COLUMN lease_expiry real DEFAULT 0")
+            self.run.execute(
+                "CREATE INDEX tasks_lease ON tasks_control (lease_owner)")
+            self.run.execute("PRAGMA user_version = 2")
+            self.db.commit()
+        if version < 3 and self.migration(3):
+            # per-frame results of FEP; attempts - number of runs that did not produce the frame
+            self.run.execute(
+                "CREATE TABLE fep_frames (directory text, state text, frame integer, done integer DEFAULT 0, attempts integer DEFAULT 0, "
+                "PRIMARY KEY (directory, state, frame))")
+            self.run.execute("PRAGMA user_version = 3")
+            self.db.commit()
+        if version < 4 and self.migration(4):
+            # directories of jobs shared by several directories (`--pack`)
+            self.run.execute(
+                "CREATE TABLE packs (jobID text, directory text, stage integer, PRIMARY KEY (jobID, directory))")
+            self.run.execute(
+                "CREATE INDEX packs_directory ON packs (directory)")
+            self.run.execute("PRAGMA user_version = 4")
+            self.db.commit()
+        if version < 5 and self.migration(5):
+            # priority of submission; partition of the submitted job ('' - of the script)
+            self.run.execute(
+                "ALTER TABLE tasks_control ADD COLUMN priority integer DEFAULT 0")
+            self.run.execute(
+                "ALTER TABLE tasks_control ADD COLUMN partition text DEFAULT ''")
+            self.run.execute("PRAGMA user_version = 5")
+            self.db.commit()
+        if version < 6 and self.migration(6):
+            # estimates of dG of the legs after every batch of adaptive FEP
+            self.run.execute(
+                "CREATE TABLE fep_estimates (directory text, batch integer, leg text, frames integer, dG real, SE real, time real, "
+                "PRIMARY KEY (directory, batch, leg))")
+            self.run.execute("PRAGMA user_version = 6")
+            self.db.commit()
+        if version < 7 and self.migration(7):
+            # time of every change of stage or status (written by triggers, so that no
+            # transition is missed); accounting and mdrun performance of finished jobs
+            now = "(julianday('now') - 2440587.5) * 86400.0"
+            self.run.execute(
+                "CREATE TABLE transitions (directory text, stage integer, status integer, time real)")
+            self.run.execute(
+                "CREATE INDEX transitions_directory ON transitions (directory, time)")
+            self.run.execute(
+                f"CREATE TRIGGER tasks_added AFTER INSERT ON tasks_control BEGIN "
+                f"INSERT INTO transitions VALUES (NEW.directory, NEW.stage, NEW.status, {now}); END")
+            self.run.execute(
+                f"CREATE TRIGGER tasks_changed AFTER UPDATE OF stage, status ON tasks_control "
+                f"WHEN OLD.stage != NEW.stage OR OLD.status != NEW.status BEGIN "
+                f"INSERT INTO transitions VALUES (NEW.directory, NEW.stage, NEW.status, {now}); END")
+            self.run.execute(
+                "CREATE TABLE metrics (directory text, stage integer, jobID text, partition text, submit real, start real, "
+                "end real, elapsed real, cpu real, ns_day real, logs integer, PRIMARY KEY (directory, stage, jobID))")
+            self.run.execute("PRAGMA user_version = 7")
+            self.db.commit()
+        if version < 8 and self.migration(8):
+            # ns/day of `--tune` benchmarks; for FEP (stage 4), ranks are concurrent frames
+            # of one rank each and ns/day is their sum
+            self.run.execute(
+                "CREATE TABLE layouts (partition text, stage integer, atoms integer, ranks integer, threads integer, npme integer, "
+                "ns_day real, time real, PRIMARY KEY (partition, stage, atoms, ranks, threads, npme))")
+            self.run.execute("PRAGMA user_version = 8")
+            self.db.commit()
 
     def get_task(self, directory):
-        self.FEP_table_exists()
         FEP_select = self.run.execute(
-            f"SELECT * FROM tasks_control WHERE directory = '{directory}'").fetchall()
+            "SELECT directory, stage, status, taskID, chain, lease_owner, lease_expiry FROM tasks_control WHERE directory = ?", (directory,)).fetchall()
         return FEP_select
 
-    def stop_task(self, task):
+    def new_task(self, stage, directory):
+        task = self.TASK[stage](directory, self.root)
+        task.executor = self.executor
+        if isinstance(task, FEPPreparation):
+            task.workers = self.prep_workers
+        task.lazy_tpr = self.lazy_tpr
+        task.layout = self.layout
+        if isinstance(task, MD):
+            task.time = self.md_time
+            task.mode = self.md_mode
+            task.packable = self.md_mode != "multidir"
+        if isinstance(task, FEP):
+            task.time = self.fep_time
+        if isinstance(task, ResultProcessing):
+            task.compact = self.compact
+        # scripts are written for the partition of the layout, see `--tune`
+        task.tuned = self.tuned.get((self.layout["partition"], stage), [])
+        return task
+
+    def tune(self, directory, steps):
+        # a benchmark job on every partition for the water and protein systems of `directory`;
+        # the results are collected by `collect_tuning` as soon as the logs are written
+        systems = []
+        for state in ("stateA_water", "stateA_protein"):
+            path = f"{self.root}/{directory}/{state}"
+            tpr = f"{path}/tpr0.tpr" if os.path.exists(f"{path}/tpr0.tpr") else f"{path}/eq.tpr"
+            atoms = gro_atoms(f"{path}/emout.gro")
+            if atoms == None or not os.path.exists(tpr):
+                print(f"'{directory}': {state}/emout.gro and {state}/eq.tpr are required, run MD preparation first")
+                return
+            systems.append((atoms, tpr))
+        for partition in self.partitions:
+            tune = f"{self.root}/tune/{partition}"
+            os.makedirs(tune, exist_ok=True)
+            for log in glob.glob(f"{tune}/*.log"):
+                os.remove(log)
+            self.run.execute("DELETE FROM layouts WHERE partition = ?", (partition,))
+            open(f"{tune}/tune.sh", "w").write(TUNEscript(tune, systems, self.layout["cores_per_node"], steps))
+            open(f"{tune}/tune.slurm", "w").write(SLURMscript(f"{tune}/tune.sh",
+                                                              nodes=1, ntasks=1, ntasks_per_node=1, jobname=f"tune-{partition}", time="04:00:00", partition=partition, cores_per_node=self.layout["cores_per_node"]))
+            print(f"{partition}: benchmark job {SLURMbatch(f'{tune}/tune.slurm', partition=partition)}")
+        self.db.commit()
+
+    def collect_tuning(self):
+        # ns/day of the logs of `--tune` jobs (`tune/<partition>/`, see `TUNEscript`);
+        # result: {(partition, stage): [(atoms, ranks, threads, npme) of the fastest layout of every size]}
+        known = {row for row in self.run.execute(
+            "SELECT partition, stage, atoms, ranks, threads, npme FROM layouts")}
+        results = {}
+        for log in glob.glob(f"{self.root}/tune/*/*.log"):
+            try:
+                key = tuple(int(value) for value in os.path.basename(log)[:-len(".log")].split("-"))
+            except ValueError:
+                continue
+            rate = ns_per_day(log)
+            if len(key) != 6 or rate == None:
+                continue
+            results.setdefault((os.path.basename(os.path.dirname(log)),) + key[:5], []).append(rate)
+        # concurrent FEP frames count only if all of them have finished
+        rows = [key + (sum(rates), time.time()) for key, rates in results.items()
+                if key not in known and (key[1] != 4 or len(rates) == key[3])]
+        if rows != []:
+            self.run.executemany(
+                "INSERT OR REPLACE INTO layouts (partition, stage, atoms, ranks, threads, npme, ns_day, time) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self.db.commit()
+        tuned = {}
+        for partition, stage, atoms, ranks, threads, npme, _ in self.run.execute(
+                "SELECT partition, stage, atoms, ranks, threads, npme, MAX(ns_day) FROM layouts GROUP BY partition, stage, atoms"):
+            tuned.setdefault((partition, stage), []).append((atoms, ranks, threads, npme))
+        return tuned
+
+    def stop_task(self, task, directory=None):
+        jobs = []
+        for job in task.split(";"):
+            if not job.startswith("pack:"):
+                jobs.append(job)
+                continue
+            # other directories of the pack keep running, the runner stops this one
+            open(f"{self.root}/{directory}/pack-{job[5:]}.cancel", "w").close()
+            others, = self.run.execute(
+                "SELECT COUNT(*) FROM tasks_control WHERE taskID = ? AND status = 2 AND directory != ?", (job, directory)).fetchone()
+            if others == 0:
+                SLURMstop(job)
+        task = ";".join(jobs)
+        LOCALstop(task)
         SLURMstop(task)
 
-    def add_task(self, task, force):
+    def submit_chain(self, directory, stage, partition=None):
+        # the stage itself and all next stages are submitted at once,
+        # each stage starts only after successful finish of the previous one;
+        # result: `ID;ID of the next stage;...`
+        taskIDs = []
+        for next_stage in range(stage, 6):
+            task = self.new_task(next_stage, directory)
+            task.partition = partition
+            task.chain = True
+            if next_stage != stage:
+                task.prepare()
+            taskID = task.submit(taskIDs[-1] if taskIDs != [] else None)
+            if "ERROR_SLURM" in taskID:
+                self.stop_task(";".join(taskIDs))
+                return "ERROR_SLURM"
+            taskIDs.append(taskID)
+        return ";".join(taskIDs)
+
+    def count_jobs(self):
+        # SLURM jobs in flight of all controllers per stage and per partition
+        jobs = "FROM tasks_control WHERE status = 2 AND taskID != '' AND taskID NOT LIKE 'local:%'"
+        self.jobs_stage = dict(self.run.execute(
+            f"SELECT stage, COUNT(DISTINCT taskID) {jobs} GROUP BY stage").fetchall())
+        self.jobs_partition = {}
+        for partition, count in self.run.execute(f"SELECT partition, COUNT(DISTINCT taskID) {jobs} GROUP BY partition"):
+            partition = partition if partition != "" else self.layout["partition"]
+            self.jobs_partition[partition] = self.jobs_partition.get(partition, 0) + count
+
+    def schedule(self, task, stage, submit):
+        # `submit()` is called with `task.partition` set to the first partition with free slots,
+        # and to the next ones while sbatch fails (e.g. MaxSubmitJobs is reached);
+        # "LIMIT" if there are no free slots for the stage or in all partitions
+        limit = self.stage_limits.get(stage)
+        if limit != None and self.jobs_stage.get(stage, 0) >= limit:
+            return "LIMIT"
+        res = "LIMIT"
+        for partition, limit in self.partitions.items():
+            if limit != None and self.jobs_partition.get(partition, 0) >= limit:
+                continue
+            task.partition = partition
+            res = submit()
+            if "ERROR_SLURM" not in res:
+                self.jobs_stage[stage] = self.jobs_stage.get(stage, 0) + 1
+                self.jobs_partition[partition] = self.jobs_partition.get(partition, 0) + 1
+                return res
+        return res
+
+    def add_task(self, task, force, priority=0):
         directory, stage = task
         istage = int(stage)
         if not 1 <= istage <= 5:
@@ -395,13 +1852,17 @@ class FEPdb:
             return
         task = self.get_task(directory)
         if task != []:
+            if self.leased(task[0]) and not force:
+                print(f"'{directory}' is being processed by another controller ({task[0][5]}).")
+                return
             if force:
-                _, _, tst, tt = task[0]
-                if tst == 1:
+                _, _, tst, tt, tc, _, _ = task[0]
+                if tst == 2:
                     # we need to stop SLURM tasks firstly
-                    self.stop_task(tt)
+                    self.stop_task(f"{tt};{tc}", directory)
                 self.run.execute(
-                    f"UPDATE tasks_control SET stage = {stage}, status = 0, taskID = '' WHERE directory = '{directory}'")
+                    "UPDATE tasks_control SET stage = ?, status = 0, taskID = '', chain = '', lease_owner = '', lease_expiry = 0, priority = ?, partition = '' "
+                    "WHERE directory = ?", (istage, priority, directory))
             else:
                 print(
                     f"Run `./{sys.argv[0]} --add {directory} --stage {stage} --force` for overriding '{directory}' directory")
@@ -409,9 +1870,8 @@ class FEPdb:
                     "  or remove this task via `./{sys.argv[0]} --remove {directory}`")
                 return
         else:
-            self.run.execute("INSERT INTO tasks_control VALUES (?, ?, ?, ?)",
-                             (directory, stage, self.STATUS_rev["Not started"], ""))
-        self.db.commit()
+            self.run.execute("INSERT INTO tasks_control (directory, stage, status, taskID, chain, priority) VALUES (?, ?, ?, ?, ?, ?)",
+                             (directory, istage, self.STATUS_rev["Not started"], "", "", priority))
 
     def remove_task(self, directory, force):
         task = self.get_task(directory)
@@ -419,83 +1879,517 @@ class FEPdb:
             print(f"Task {directory} does not exist!")
             return
         task = task[0]
-        td, tsg, tst, tt = task
-        if tst == 1 and not force:
+        td, tsg, tst, tt, tc, _, _ = task
+        if self.leased(task) and not force:
+            print(
+                f"'{directory}' is being processed by another controller ({task[5]}). Use `--force` for removing this task.")
+            return
+        if tst == 2 and not force:
             print(
                 f"'{directory}' is in progress... Use `--force` for removing this task.")
             return
-        elif tst == 1 and force:
-            self.stop_task(tt)
+        elif tst == 2 and force:
+            # the whole chain of submitted stages is cancelled
+            self.stop_task(f"{tt};{tc}", directory)
+        self.run.execute(
+            "DELETE FROM tasks_control WHERE directory = ?", (directory,))
+        self.run.execute(
+            "DELETE FROM fep_frames WHERE directory = ?", (directory,))
+        self.run.execute(
+            "DELETE FROM fep_estimates WHERE directory = ?", (directory,))
+        self.run.execute(
+            "DELETE FROM packs WHERE directory = ?", (directory,))
         self.run.execute(
-            f"DELETE FROM tasks_control WHERE directory = '{directory}'")
+            "DELETE FROM transitions WHERE directory = ?", (directory,))
+        self.run.execute(
+            "DELETE FROM metrics WHERE directory = ?", (directory,))
+
+    def lease_tasks(self, batch, size):
+        # atomically (BEGIN IMMEDIATE) takes up to `size` tasks that are not leased
+        # by other controllers or whose lease is expired (e.g. after a crash)
+        now = time.time()
+        self.run.execute(
+            "UPDATE tasks_control SET lease_owner = ?, lease_expiry = ? WHERE directory IN "
+            "(SELECT directory FROM tasks_control WHERE (lease_owner = '' OR lease_expiry < ?) AND lease_owner NOT LIKE ? "
+            "AND status != 4 AND NOT (stage = 5 AND status = 5) ORDER BY priority DESC, stage DESC LIMIT ?)",
+            (f"{self.owner}:{batch}", now + self.lease_ttl, now, f"{self.owner}:%", size))
+        leased = self.run.rowcount
         self.db.commit()
+        return leased
+
+    def release_tasks(self):
+        # `owner:` <= lease_owner < `owner;` is `owner:%`, but with the index
+        self.run.execute(
+            "UPDATE tasks_control SET lease_owner = '', lease_expiry = 0 WHERE lease_owner >= ? AND lease_owner < ?",
+            (f"{self.owner}:", f"{self.owner};"))
+        self.db.commit()
+
+    def leased(self, task):
+        # leased by another controller
+        _, _, _, _, _, owner, expiry = task
+        return owner != "" and not owner.startswith(f"{self.owner}:") and expiry >= time.time()
 
-    def run_tasks(self):
-        TaskClass = {1: MDPreparation, 2: MD,
-                     3: FEPPreparation, 4: FEP, 5: ResultProcessing}
+    def update(self, statement, parameters=(), many=False):
+        # statements are written by `flush` in one short transaction
+        self.pending.append((statement, parameters, many))
+
+    def flush(self):
+        if self.pending == []:
+            return
+        for statement, parameters, many in self.pending:
+            if many:
+                self.run.executemany(statement, parameters)
+            else:
+                self.run.execute(statement, parameters)
+        # the lease of the current batch is prolonged
+        self.run.execute(
+            "UPDATE tasks_control SET lease_expiry = ? WHERE lease_owner = ?", (time.time() + self.lease_ttl, self.batch))
+        self.db.commit()
+        self.pending = []
+
+    def run_tasks(self, chain=False):
+        # tasks are processed in leased batches, so that several controllers may
+        # share one database; all transitions of a batch are written at once,
+        # only submissions are written immediately, so that job IDs are never lost
+        changed = 0  # number of tasks that changed their stage or status
+        batch = 0
+        try:
+            while self.lease_tasks(batch, self.lease_batch) > 0:
+                self.batch = f"{self.owner}:{batch}"
+                changed += self.run_batch(self.batch, chain)
+                batch += 1
+        finally:
+            self.flush()
+            self.release_tasks()
+        return changed
+
+    def run_batch(self, owner, chain):
         #CallClass = {0:prepare, 1:run, 2:wait, 3:check}
+        changed = 0
+        # processes started by `local` executor on this host, the limit is `self.workers`
+        running, = self.run.execute(
+            "SELECT COUNT(*) FROM tasks_control WHERE status = 2 AND taskID LIKE ?", (f"local:{socket.gethostname()}:%",)).fetchone()
+        self.count_jobs()
         for status in self.STATUS.keys():
             if self.STATUS[status] == "Failed":
                 continue
+            # higher priority first, then tasks closest to completion, so that results come early
             tasks = self.run.execute(
-                f"SELECT * FROM tasks_control WHERE status = {status}").fetchall()
+                "SELECT directory, stage, status, taskID, chain FROM tasks_control WHERE status = ? AND lease_owner = ? "
+                "ORDER BY priority DESC, stage DESC, directory", (status, owner)).fetchall()
+            states = {}
+            finished = []  # (directory, stage, taskID, task) of finished jobs, see `record_metrics`
+            if status == 1 and self.pack > 1 and not chain:
+                tasks, packed = self.submit_packs(tasks)
+                changed += packed
+            if status == 2:
+                # single bulk squeue/sacct query shared by all waiting tasks
+                states = SLURMstates([task_db[3] for task_db in tasks])
             for task_db in tasks:
-                dir, stage, _, taskID = task_db
-                task = TaskClass[stage](dir, self.root)
+                dir, stage, _, taskID, taskChain = task_db
+                task = self.new_task(stage, dir)
                 increase = True
                 if status == 0:
+                    task.cached = self.restore_water(task, dir, stage)
+                    if isinstance(task, FEP):
+                        self.update(
+                            "DELETE FROM fep_frames WHERE directory = ?", (dir,))
+                        self.update(
+                            "DELETE FROM fep_estimates WHERE directory = ?", (dir,))
+                        self.active_frames(task, 0)
                     task.prepare()
                 elif status == 1:
-                    res = task.run()
-                    if "ERROR_SLURM" in res:
+                    local = not chain and isinstance(
+                        task, LocalTask) and self.executor == "local"
+                    if local and running >= self.workers:
+                        continue
+                    if chain:
+                        res = self.schedule(task, stage, lambda: self.submit_chain(dir, stage, task.partition))
+                        res, _, taskChain = res.partition(";")
+                    elif not isinstance(task, LocalTask) or self.executor == "slurm":
+                        res = self.schedule(task, stage, task.run)
+                    else:
+                        res = task.run()
+                    if "ERROR_SLURM" in res or res == "LIMIT":
                         increase = False
                     else:
-                        self.run.execute(
-                            f"UPDATE tasks_control SET taskID = '{res}' WHERE directory = '{dir}'")
-                        self.db.commit()
+                        if local:
+                            running += 1
+                        self.update(
+                            "UPDATE tasks_control SET taskID = ?, chain = ?, partition = ? WHERE directory = ?", (res, taskChain, task.partition or "", dir))
+                        self.increase_task(dir, stage, status)
+                        self.flush()
+                        increase = False
+                        changed += 1
                 elif status == 2:
-                    res = task.wait(taskID)
+                    res = task.wait(taskID, states)
+                    if "Waiting" not in res:
+                        finished.append((dir, stage, taskID, task))
                     if "Waiting" in res:
                         increase = False
+                    elif "Failed" in res or "Timeout" in res:
+                        increase = False
+                        changed += 1
+                        # dependent jobs would never start
+                        self.stop_task(taskChain)
+                        # results of recoverable stages are checked, the missing parts are resubmitted;
+                        # stages stopped by the wall time are continued from checkpoints
+                        resume = task.recoverable or (task.resumable and ("Timeout" in res or task.stopped()))
+                        failed = 3 if resume else 4
+                        self.update(
+                            "UPDATE tasks_control SET stage = ?, status = ?, taskID = '', chain = '' WHERE directory = ?", (stage, failed, dir))
+                    elif taskChain != "":
+                        # the next stage of the chain is already submitted; it is kept only if the results
+                        # of this one are complete, as the job exits with 0 also when stopped by the wall time
+                        increase = False
+                        changed += 1
+                        res = task.check()
+                        if res == "PASS":
+                            nextID, _, taskChain = taskChain.partition(";")
+                            self.update(
+                                "UPDATE tasks_control SET stage = ? + 1, taskID = ?, chain = ? WHERE directory = ?", (stage, nextID, taskChain, dir))
+                        else:
+                            # the missing parts are resubmitted out of the chain, see status 3
+                            print(f"'{dir}': {self.STAGE[stage]} of the chain is {res}, the next stages are cancelled")
+                            self.stop_task(taskChain)
+                            self.update(
+                                "UPDATE tasks_control SET stage = ?, status = ?, taskID = '', chain = '' WHERE directory = ?", (stage, 4 if res == "FAIL" else 3, dir))
                 elif status == 3:
                     increase = False
+                    if isinstance(task, FEP):
+                        batches, = self.run.execute(
+                            "SELECT COUNT(DISTINCT batch) FROM fep_estimates WHERE directory = ?", (dir,)).fetchone()
+                        self.active_frames(task, batches)
                     res = task.check()
-                    if "PASS":
-                        self.run.execute(
-                            f"UPDATE tasks_control SET stage = {stage}, status = 5, taskID = '' WHERE directory = '{dir}'")
-                    else:
-                        self.run.execute(
-                            f"UPDATE tasks_control SET stage = {stage}, status = 4, taskID = '' WHERE directory = '{dir}'")
-                    self.db.commit()
-                if increase:
-                    self.increase_task(dir, stage, status)
+                    if res == "PASS" and isinstance(task, FEP) and self.adaptive > 0:
+                        res = self.adapt(task, dir, stage)
+                    if res == "INCOMPLETE" and isinstance(task, FEP):
+                        res = self.resubmit_frames(task, dir, stage)
+                    elif res == "INCOMPLETE":
+                        res = self.resubmit(task, dir, stage)
+                    if res == "PASS":
+                        self.store_water(task, dir, stage)
+                        self.update(
+                            "UPDATE tasks_control SET stage = ?, status = 5, taskID = '' WHERE directory = ?", (stage, dir))
+                    elif res == "FAIL":
+                        self.update(
+                            "UPDATE tasks_control SET stage = ?, status = 4, taskID = '' WHERE directory = ?", (stage, dir))
+                    # otherwise the job is not submitted, the task is checked again on the next pass
+                    if res != "ERROR_SLURM":
+                        changed += 1
+                if increase and self.increase_task(dir, stage, status):
+                    changed += 1
+            if finished != []:
+                self.record_metrics(finished)
+            # the next status sees the transitions of this one
+            self.flush()
+        return changed
+
+    def restore_water(self, task, directory, stage):
+        # water legs of the stage from the cache; the key is taken when the directory is not changed yet
+        if self.cache == None or stage == 5:
+            return ()
+        if stage == 1 and not os.path.exists(f"{task.path}/water.key"):
+            key = water_key(task.path, task.frames)
+            if key == None:
+                return ()
+            open(f"{task.path}/water.key", "w").write(f"{key}\n")
+        if not os.path.exists(f"{task.path}/water.key"):
+            return ()
+        key = open(f"{task.path}/water.key").read().strip()
+        if not self.cache.restore(task.path, key, stage):
+            return ()
+        print(f"'{directory}': water legs of {self.STAGE[stage]} are taken from the cache")
+        return WATER_STATES
+
+    def store_water(self, task, directory, stage):
+        if self.cache == None or stage == 5 or not os.path.exists(f"{task.path}/water.key"):
+            return
+        key = open(f"{task.path}/water.key").read().strip()
+        try:
+            self.cache.store(task.path, key, stage)
+        except OSError as e:
+            print(f"'{directory}': water legs are not stored in the cache: {e}")
+
+    def active_frames(self, task, batches):
+        # frames of the first `batches` + 1 batches of adaptive FEP
+        if self.adaptive == 0:
+            return
+        frames = task.frames if self.max_frames == None else min(task.frames, self.max_frames)
+        task.active = frame_order(task.frames)[:min(frames, (batches + 1) * self.adaptive)]
+
+    def adapt(self, task, directory, stage):
+        # all frames of the batch are done: dG of the legs from all finished frames;
+        # the next batch is submitted while SE of any leg is above the target
+        try:
+            import dhdl_analysis
+        except ImportError as e:
+            print(f"'{directory}': adaptive FEP is not possible ({e}), all frames are accepted")
+            return "PASS"
+        batch, = self.run.execute(
+            "SELECT COUNT(DISTINCT batch) FROM fep_estimates WHERE directory = ?", (directory,)).fetchone()
+        converged = True
+        estimates = []
+        for leg, (stateA, stateB) in dhdl_analysis.LEGS.items():
+            wf = dhdl_analysis.cached_works(f"{task.path}/{stateA}", 0, task.done_frames(stateA))
+            wr = dhdl_analysis.cached_works(f"{task.path}/{stateB}", 1, task.done_frames(stateB))
+            dG, SE = None, None
+            if len(wf) >= 2 and len(wr) >= 2:
+                result = dhdl_analysis.estimate(wf, wr)["BAR"]
+                dG, SE = result["dG"], result["SD"]
+                print(f"'{directory}': batch {batch}, {leg}: dG = {dG:.2f} +- {SE:.2f} kJ/mol ({len(wf)}/{len(wr)} frames)")
+            estimates.append((directory, batch, leg, min(len(wf), len(wr)), dG, SE, time.time()))
+            converged = converged and SE != None and SE < self.target_se
+        # the number of batches is the number of the estimated ones
+        store = ("INSERT OR REPLACE INTO fep_estimates (directory, batch, leg, frames, dG, SE, time) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                 estimates)
+        frames = task.frames if self.max_frames == None else min(task.frames, self.max_frames)
+        if converged or len(task.active) >= frames:
+            self.update(*store, many=True)
+            return "PASS"
+        submitted = task.active
+        self.active_frames(task, batch + 1)
+        task.pending = [(state, frame) for frame in task.active if frame not in submitted
+                        for state, _, _ in task.states()]
+        taskID = self.schedule(task, stage, task.submit)
+        if "ERROR_SLURM" in taskID or taskID == "LIMIT":
+            # estimated again on the next pass
+            return "ERROR_SLURM"
+        task.write_queue(task.pending)
+        print(f"'{directory}': submitting frames {len(submitted)}-{len(task.active) - 1}")
+        self.update(*store, many=True)
+        self.update(
+            "UPDATE tasks_control SET stage = ?, status = 2, taskID = ?, partition = ? WHERE directory = ?", (stage, taskID, task.partition, directory))
+        self.flush()
+        return taskID
+
+    def submit_packs(self, tasks):
+        # Prepared MD and FEP of several directories are submitted as one job each `--pack`
+        # directories; returns the tasks left for usual submission and the number of packed ones
+        rest, groups = [], {}
+        for task_db in tasks:
+            task = self.new_task(task_db[1], task_db[0])
+            if task.packable:
+                groups.setdefault(task_db[1], []).append((task_db[0], task))
+            else:
+                rest.append(task_db)
+        packed = 0
+        os.makedirs(f"{self.root}/packs", exist_ok=True)
+        for stage, group in groups.items():
+            for i in range(0, len(group), self.pack):
+                members = group[i:i + self.pack]
+                if len(members) == 1:
+                    rest += [task_db for task_db in tasks if task_db[0] == members[0][0]]
+                    continue
+                name = f"{self.root}/packs/{self.STAGE[stage].replace(' ', '_')}-{os.getpid()}-{int(time.time())}-{i // self.pack}"
+                task = members[0][1]
+                taskID = self.schedule(task, stage, lambda: task.submit_pack([task for _, task in members], name))
+                if "ERROR_SLURM" in taskID or taskID == "LIMIT":
+                    continue
+                for directory, _ in members:
+                    self.update(
+                        "UPDATE tasks_control SET taskID = ?, partition = ? WHERE directory = ?", (f"pack:{taskID}", task.partition, directory))
+                    self.increase_task(directory, stage, 1)
+                self.update("INSERT OR REPLACE INTO packs (jobID, directory, stage) VALUES (?, ?, ?)",
+                            [(taskID, directory, stage) for directory, _ in members], many=True)
+                # job IDs must not be lost
+                self.flush()
+                packed += len(members)
+        return rest, packed
+
+    def record_metrics(self, finished):
+        # sacct accounting of the finished jobs (one call for all of them) and mean ns/day
+        # of the mdrun logs written since the start of the job; core-hours of a pack
+        # are shared equally by its directories
+        accounting = SLURMaccounting(SLURMjobs([taskID for _, _, taskID, _ in finished]))
+        rows = []
+        for directory, stage, taskID, task in finished:
+            for job in SLURMjobs([taskID]):
+                if job not in accounting:
+                    continue
+                info = accounting[job]
+                members, = self.run.execute(
+                    "SELECT COUNT(*) FROM packs WHERE jobID = ?", (job,)).fetchone()
+                rates = []
+                if info["start"] != None:
+                    rates = [rate for rate in (ns_per_day(log) for log in task.logs()
+                                               if os.path.getmtime(log) >= info["start"]) if rate != None]
+                rows.append((directory, stage, job, info["partition"], info["submit"], info["start"], info["end"],
+                             info["elapsed"], info["cpu"] / max(1, members),
+                             sum(rates) / len(rates) if rates != [] else None, len(rates)))
+        self.update("INSERT OR REPLACE INTO metrics (directory, stage, jobID, partition, submit, start, end, elapsed, cpu, ns_day, logs) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows, many=True)
+
+    def resubmit(self, task, directory, stage):
+        # continuation job of the stage
+        taskID = self.schedule(task, stage, task.submit)
+        if "ERROR_SLURM" in taskID or taskID == "LIMIT":
+            # checked again on the next pass
+            return "ERROR_SLURM"
+        print(f"'{directory}': continuing {', '.join(task.missing)} from checkpoints")
+        self.update(
+            "UPDATE tasks_control SET stage = ?, status = 2, taskID = ?, partition = ? WHERE directory = ?", (stage, taskID, task.partition, directory))
+        self.flush()
+        return taskID
+
+    def resubmit_frames(self, task, directory, stage):
+        # only the missing (state, frame) pairs are queued and submitted again; an attempt
+        # is counted for the frames started but not finished, not for the ones a job
+        # stopped by the wall time (or failed) has never reached
+        attempts = {(state, frame): tries for state, frame, tries in self.run.execute(
+            "SELECT state, frame, attempts FROM fep_frames WHERE directory = ?", (directory,))}
+        started = task.started_frames()
+        exhausted = [pair for pair in task.missing
+                     if pair in started and attempts.get(pair, 0) + 1 >= self.max_attempts]
+        if exhausted != []:
+            print(f"'{directory}': {len(exhausted)} frames are failed {self.max_attempts} times, e.g. " +
+                  ", ".join(f"{state}/dhdl{frame}.xvg" for state, frame in exhausted[:5]))
+            return "FAIL"
+        # the queue is written only when the job is submitted (before it starts):
+        # until then the files of the task are left as they are
+        task.pending = task.missing
+        taskID = self.schedule(task, stage, task.submit)
+        if "ERROR_SLURM" in taskID or taskID == "LIMIT":
+            # checked again on the next pass
+            return "ERROR_SLURM"
+        task.write_queue(task.pending)
+        print(f"'{directory}': resubmitting {len(task.missing)} missing frames")
+        missing = set(task.missing)
+        failed = missing & started
+        self.update("INSERT OR REPLACE INTO fep_frames (directory, state, frame, done, attempts) VALUES (?, ?, ?, ?, ?)",
+                    [(directory, state, frame, int((state, frame) not in missing),
+                      attempts.get((state, frame), 0) + int((state, frame) in failed))
+                     for state, _, _ in FEP_STATES for frame in task.frame_list()], many=True)
+        self.update(
+            "UPDATE tasks_control SET stage = ?, status = 2, taskID = ?, partition = ? WHERE directory = ?", (stage, taskID, task.partition, directory))
+        self.flush()
+        return taskID
+
+    def daemon(self, poll_min, poll_max, chain=False):
+        stop = threading.Event()
+
+        def handler(signum, frame):
+            print(f"Signal {signum} is received, stopping after the current pass...")
+            stop.set()
+        signal.signal(signal.SIGINT, handler)
+        signal.signal(signal.SIGTERM, handler)
+        delay = poll_min
+        while not stop.is_set():
+            changed = self.run_tasks(chain)
+            self.db.commit()
+            if changed > 0:
+                # something has moved: the next stage may already be runnable
+                delay = poll_min
+                continue
+            stop.wait(delay)
+            delay = min(2 * delay, poll_max)
 
     def increase_task(self, directory, stage, status):
         if stage == 5 and self.STATUS[status] == "Done":
-            return
+            return False
         if self.STATUS[status] == "Failed":
-            return
+            return False
         if self.STATUS[status] == "Done":
-            self.run.execute(
-                f"UPDATE tasks_control SET stage = {stage}+1, status = 0, taskID = '' WHERE directory = '{directory}'")
+            self.update(
+                "UPDATE tasks_control SET stage = ? + 1, status = 0, taskID = '' WHERE directory = ?", (stage, directory))
+        elif self.STATUS[status] == "Prepared":
+            # keep the submitted job IDs for the "In progress..." status
+            self.update(
+                "UPDATE tasks_control SET stage = ?, status = ? + 1 WHERE directory = ?", (stage, status, directory))
         else:
-            self.run.execute(
-                f"UPDATE tasks_control SET stage = {stage}, status = {status}+1, taskID = '' WHERE directory = '{directory}'")
-        self.db.commit()
-
-    def dump(self, filename):
-        tasks = self.run.execute(
-            f"SELECT * FROM tasks_control").fetchall()
-        out = " Directory ; Stage ; Status ; TaskIDs\n"
-        if filename == None:
-            out = "Current status:\n"
-        for task in tasks:
-            dir, stage, status, taskIDs = task
-            out += f"{dir:>30} ; {self.STAGE[stage]:>20} ; {self.STATUS[status]:>15} ; {taskIDs:>10}\n"
-        if filename == None:
-            print(out)
+            self.update(
+                "UPDATE tasks_control SET stage = ?, status = ? + 1, taskID = '' WHERE directory = ?", (stage, status, directory))
+        return True
+
+    def query(self, columns, stages=None, statuses=None, pattern=None, tail=""):
+        # tasks selected by stages, statuses and a glob pattern of the directory;
+        # the result is a separate cursor, rows are read from it one by one
+        where, parameters = [], []
+        for column, values in (("stage", stages), ("status", statuses)):
+            if values != None:
+                where.append(f"{column} IN ({', '.join('?' * len(values))})")
+                parameters += values
+        if pattern != None:
+            where.append("directory GLOB ?")
+            parameters.append(pattern)
+        where = f" WHERE {' AND '.join(where)}" if where != [] else ""
+        return self.db.execute(f"SELECT {columns} FROM tasks_control{where} {tail}", parameters)
+
+    def dump(self, filename, stages=None, statuses=None, pattern=None, json_format=False):
+        # rows are written as they are read, in the order of directories (primary key)
+        rows = self.query("directory, stage, status, taskID", stages, statuses, pattern, "ORDER BY directory")
+        out = sys.stdout if filename == None else open(filename, "w")
+        if json_format:
+            out.write("[")
+            separator = "\n"
+            for dir, stage, status, taskIDs in rows:
+                out.write(separator + json.dumps({"directory": dir, "stage": self.STAGE[stage],
+                                                  "status": self.STATUS[status], "taskID": taskIDs}))
+                separator = ",\n"
+            out.write("\n]\n")
         else:
-            open(filename, "w").write(out)
+            out.write("Current status:\n" if filename == None else " Directory ; Stage ; Status ; TaskIDs\n")
+            for dir, stage, status, taskIDs in rows:
+                out.write(f"{dir:>30} ; {self.STAGE[stage]:>20} ; {self.STATUS[status]:>15} ; {taskIDs:>10}\n")
+            if filename == None:
+                out.write("\n")
+        if filename != None:
+            out.close()
+
+    def summary(self, stages=None, statuses=None, pattern=None):
+        # counted by SQLite (GROUP BY), only the counts are read
+        print(f"{'Stage':>20} ; {'Status':>15} ; {'Tasks':>8}")
+        total = 0
+        for stage, status, count in self.query("stage, status, COUNT(*)", stages, statuses, pattern,
+                                               "GROUP BY stage, status ORDER BY stage, status"):
+            print(f"{self.STAGE[stage]:>20} ; {self.STATUS[status]:>15} ; {count:>8}")
+            total += count
+        print(f"{'Total':>20} ; {'':>15} ; {total:>8}\n")
+
+    def report(self):
+        # latency of a stage is the time from its first transition to `Done`
+        # (or to the start of the next stage of a chain)
+        segments = []  # (directory, stage, [(status, time)]) of consecutive transitions of one stage
+        for directory, stage, status, moment in self.run.execute(
+                "SELECT directory, stage, status, time FROM transitions ORDER BY directory, time, rowid"):
+            if segments == [] or segments[-1][:2] != (directory, stage):
+                segments.append((directory, stage, []))
+            segments[-1][2].append((status, moment))
+        latency = {}
+        for i, (directory, stage, transitions) in enumerate(segments):
+            end = next((moment for status, moment in transitions if status == 5), None)
+            if end == None and i + 1 < len(segments) and segments[i + 1][:2] == (directory, stage + 1):
+                end = segments[i + 1][2][0][1]
+            if end != None:
+                latency.setdefault(stage, []).append((end - transitions[0][1]) / 3600)
+        jobs = {}
+        for stage, wait, run, rate in self.run.execute(
+                "SELECT stage, start - submit, end - start, ns_day FROM metrics"):
+            wait_stage, run_stage, rate_stage = jobs.setdefault(stage, ([], [], []))
+            if wait != None:
+                wait_stage.append(wait / 3600)
+            if run != None:
+                run_stage.append(run / 3600)
+            if rate != None:
+                rate_stage.append(rate)
+        out = ""
+        for title, values in (("Stage latency, hours", lambda stage: latency.get(stage, [])),
+                              ("Queue wait, hours", lambda stage: jobs.get(stage, ([], [], []))[0]),
+                              ("Run time, hours", lambda stage: jobs.get(stage, ([], [], []))[1]),
+                              ("Performance, ns/day", lambda stage: jobs.get(stage, ([], [], []))[2])):
+            out += f"{title}:\n{'Stage':>20} ; {'N':>6} ; {'p50':>8} ; {'p90':>8} ; {'p99':>8} ; {'max':>8}\n"
+            for stage in self.STAGE:
+                out += f"{self.STAGE[stage]:>20} ; {percentiles(values(stage))}\n"
+            out += "\n"
+        hours = {}
+        for directory, stage, cpu in self.run.execute(
+                "SELECT directory, stage, SUM(cpu) FROM metrics GROUP BY directory, stage ORDER BY directory"):
+            hours.setdefault(directory, {})[stage] = (cpu or 0) / 3600
+        out += "Core-hours:\n" + f"{'Directory':>30} ; " + " ; ".join(f"{self.STAGE[stage]:>17}" for stage in self.STAGE) + f" ; {'Total':>10}\n"
+        for directory, stages in hours.items():
+            out += f"{directory:>30} ; " + " ; ".join(f"{stages.get(stage, 0):>17.1f}" for stage in self.STAGE) + \
+                f" ; {sum(stages.values()):>10.1f}\n"
+        print(out)
 
     def __del__(self):
         self.db.commit()
@@ -505,19 +2399,43 @@ class FEPdb:
 
 if __name__ == "__main__":
     args = parse()
-    control = FEPdb(args.db)
+    control = FEPdb(args.db, args.executor, args.workers,
+                    args.prep_workers, args.lazy_tpr, args.journal,
+                    args.lease_batch, args.lease_ttl, args.max_attempts,
+                    args.md_time, args.fep_time, args.md_mode, args.layout, args.pack, args.stage_limits,
+                    args.cache_dir, args.cache_size, args.adaptive, args.target_se, args.max_frames, args.compact)
+    if args.chain and control.tuned != {}:
+        print("Layouts of the database (`--tune`) are not used by the next stages of chains")
     if args.add != None:
         for task in zip(args.add, args.stage):
-            control.add_task(task, args.force)
+            control.add_task(task, args.force, args.priority)
     if args.remove != None:
         for task in args.remove:
             control.remove_task(task, args.force)
+    control.db.commit()
+
+    if args.tune != None:
+        control.tune(args.tune, args.tune_steps)
 
     if args.run:
-        control.run_tasks()
+        control.run_tasks(args.chain)
+
+    if args.daemon:
+        control.daemon(args.poll_min, args.poll_max, args.chain)
+
+    filters = (args.filter_stage, args.filter_status, args.filter_dir)
+
+    if args.summary:
+        control.summary(*filters)
 
     if args.dump:
-        control.dump(None)
+        control.dump(None, *filters)
+
+    if args.report:
+        control.report()
 
     if args.dump_csv:
-        control.dump(args.dump_csv)
+        control.dump(args.dump_csv, *filters)
+
+    if args.dump_json:
+        control.dump(args.dump_json, *filters, json_format=True)
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+import os
+import glob
+import json
+import sqlite3
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import extract
+
+COLUMNS = ("Protein", "key", "dG_protein", "dG_water", "SD_protein", "SD_water")
+
+
+def parse():
+    parser = argparse.ArgumentParser(
+        description='Collect results of all directories', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        '--root',
+        help="Directory with directories of calculations (where the database file is)",
+        required=True)
+    parser.add_argument(
+        '--output',
+        help="Path to results.csv; default is <root>/results.csv")
+    parser.add_argument(
+        '--sqlite',
+        help="Also write the table `results` to this SQLite file")
+    parser.add_argument(
+        '--cache',
+        help="Cache of parsed result files; default is <root>/.results_cache.db")
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=os.cpu_count(),
+        help="Number of processes parsing result files")
+    args = parser.parse_args()
+    if args.output == None:
+        args.output = f"{args.root}/results.csv"
+    if args.cache == None:
+        args.cache = f"{args.root}/.results_cache.db"
+    return args
+
+
+def result_files(root):
+    # directories which have both result files
+    files = {}
+    for protein in sorted(glob.glob(f"{root}/*/result_protein/results_protein.txt")):
+        directory = os.path.dirname(os.path.dirname(protein))
+        water = f"{directory}/result_water/results_water.txt"
+        if os.path.exists(water):
+            files[os.path.basename(directory)] = (protein, water)
+    return files
+
+
+def parse_file(filename):
+    return filename, extract.get_data(filename)
+
+
+class ResultCache:
+    # parsed result files keyed by path, mtime and size
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS results_cache (path text PRIMARY KEY, mtime real, size integer, data text)")
+        self.entries = {path: (mtime, size, data) for path, mtime, size, data in
+                        self.db.execute("SELECT path, mtime, size, data FROM results_cache")}
+
+    def stale(self, filenames):
+        result = []
+        for filename in filenames:
+            stat = os.stat(filename)
+            entry = self.entries.get(filename)
+            if entry == None or entry[0] != stat.st_mtime or entry[1] != stat.st_size:
+                result.append(filename)
+        return result
+
+    def update(self, parsed):
+        for filename, data in parsed:
+            stat = os.stat(filename)
+            self.entries[filename] = (stat.st_mtime, stat.st_size, json.dumps(data))
+            self.db.execute("INSERT OR REPLACE INTO results_cache VALUES (?, ?, ?, ?)",
+                            (filename, stat.st_mtime, stat.st_size, self.entries[filename][2]))
+
+    def forget(self, filenames):
+        # entries of files that do not exist anymore
+        for filename in set(self.entries) - set(filenames):
+            del self.entries[filename]
+            self.db.execute("DELETE FROM results_cache WHERE path = ?", (filename,))
+
+    def get(self, filename):
+        return json.loads(self.entries[filename][2])
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+def rows(files, cache):
+    for name, (protein, water) in files.items():
+        for line in extract.build_table(name, cache.get(protein), cache.get(water)).split("\n"):
+            if line != "":
+                yield line.split(";")
+
+
+def write_csv(filename, table):
+    with open(filename, "w") as output:
+        output.write(";".join(COLUMNS) + "\n")
+        for row in table:
+            output.write(";".join(row) + "\n")
+
+
+def write_sqlite(filename, table):
+    db = sqlite3.connect(filename)
+    db.execute("DROP TABLE IF EXISTS results")
+    db.execute(
+        "CREATE TABLE results (protein text, key text, dG_protein real, dG_water real, SD_protein real, SD_water real)")
+    db.executemany("INSERT INTO results VALUES (?, ?, ?, ?, ?, ?)",
+                   [(row[0], row[1]) + tuple(float(value) if value != "" else None for value in row[2:])
+                    for row in table])
+    db.commit()
+    db.close()
+
+
+def aggregate(root, output, cache_file, sqlite_file=None, workers=None):
+    files = result_files(root)
+    filenames = [filename for pair in files.values() for filename in pair]
+    cache = ResultCache(cache_file)
+    cache.forget(filenames)
+    stale = cache.stale(filenames)
+    if len(stale) > 1 and workers != 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            cache.update(pool.map(parse_file, stale, chunksize=16))
+    else:
+        cache.update(map(parse_file, stale))
+    table = list(rows(files, cache))
+    cache.close()
+    write_csv(output, table)
+    if sqlite_file != None:
+        write_sqlite(sqlite_file, table)
+    print(f"{len(files)} directories, {len(stale)} result files parsed")
+
+
+if __name__ == "__main__":
+    args = parse()
+    aggregate(args.root, args.output, args.cache, args.sqlite, args.workers)
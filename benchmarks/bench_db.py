@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import tempfile
+import argparse
+import contextlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import FEP_pmx_db
+
+
+def parse():
+    parser = argparse.ArgumentParser(
+        description='Time of one --run pass against the number of tasks (SLURM states are not queried)', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        '--tasks',
+        default="10,100,1000,10000",
+        help="Numbers of tasks; comma separator is used")
+    parser.add_argument(
+        '--journal',
+        choices=["auto", "wal", "delete"],
+        default="auto",
+        help="SQLite journal mode")
+    parser.add_argument(
+        '--dir',
+        help="Directory for temporary databases (e.g. on the shared filesystem); default is the system one")
+    args = parser.parse_args()
+    args.tasks = [int(n) for n in args.tasks.split(",")]
+    return args
+
+
+def database(dirname, ntasks, stage, status, journal):
+    dbfile = f"{dirname}/FEP-{ntasks}-{stage}-{status}.db"
+    with contextlib.redirect_stdout(None):
+        control = FEP_pmx_db.FEPdb(dbfile, journal=journal)
+    # tasks in progress have SLURM job IDs, see `running`
+    control.run.executemany("INSERT INTO tasks_control (directory, stage, status, taskID, chain) VALUES (?, ?, ?, ?, '')",
+                            [(f"task{i}", stage, status, str(1000 + i) if status == 2 else "") for i in range(ntasks)])
+    control.db.commit()
+    return control
+
+
+def running(jobs):
+    # stands for the single squeue call of the pass: every job is still running
+    return {job: {"": "RUNNING"} for job in jobs}
+
+
+def timed_pass(control):
+    with contextlib.redirect_stdout(None):
+        start = time.perf_counter()
+        control.run_tasks()
+        elapsed = time.perf_counter() - start
+        del control
+    return elapsed
+
+
+if __name__ == "__main__":
+    args = parse()
+    FEP_pmx_db.SLURMstates = running
+    print(f"{'tasks':>8} {'idle pass, s':>14} {'transition pass, s':>20}")
+    with tempfile.TemporaryDirectory(dir=args.dir) as dirname:
+        for ntasks in args.tasks:
+            # idle: every task waits for its MD job, the pass leases the tasks, polls
+            # the jobs and finds that nothing has changed
+            idle = timed_pass(database(dirname, ntasks, 2, 2, args.journal))
+            # transition: every task moves from MD preparation (Done) to MD (Not started)
+            transition = timed_pass(database(dirname, ntasks, 1, 5, args.journal))
+            print(f"{ntasks:>8} {idle:>14.4f} {transition:>20.4f}")
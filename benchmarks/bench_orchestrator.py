@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import tempfile
+import argparse
+import contextlib
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import FEP_pmx_db
+
+STUBS = ("sbatch", "squeue", "sacct", "scancel", "gmx_mpi", "dhdl_analysis.py")
+FRAMES = 100  # FEP frames per state, see `Task.frames`
+
+
+def parse():
+    parser = argparse.ArgumentParser(
+        description='Passes of the orchestrator against fake SLURM and GROMACS commands', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        '--tasks',
+        default="10,100,1000",
+        help="Numbers of tasks (up to 100000); comma separator is used")
+    parser.add_argument(
+        '--passes',
+        type=int,
+        default=40,
+        help="Maximal number of --run passes per number of tasks; passes stop when all tasks are finished or failed")
+    parser.add_argument(
+        '--interval',
+        type=float,
+        default=1.0,
+        help="Pause between passes, seconds; local stages run in the background meanwhile")
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=32,
+        help="Maximal number of local stages running at once (`--executor local`)")
+    parser.add_argument(
+        '--latency',
+        type=float,
+        default=0.05,
+        help="Time of every call of a fake command, seconds")
+    parser.add_argument(
+        '--failure',
+        type=float,
+        default=0.0,
+        help="Probability of a failed sbatch call, of a failed job in sacct, of a failed gmx_mpi call and of failed dhdl analysis")
+    parser.add_argument(
+        '--journal',
+        choices=["auto", "wal", "delete"],
+        default="auto",
+        help="SQLite journal mode")
+    parser.add_argument(
+        '--dir',
+        help="Directory for temporary campaigns (e.g. on the shared filesystem); default is the system one")
+    args = parser.parse_args()
+    args.tasks = [int(n) for n in args.tasks.split(",")]
+    if not 0 <= args.failure <= 1:
+        print("--failure must be in [0, 1]!")
+        sys.exit(1)
+    return args
+
+
+def stubs(dirname, latency, failure):
+    # fake commands write their names to `calls`; every job is finished at once,
+    # `failure` of them fail; the scripts of MD and FEP are not run (their results
+    # are in the campaign), local stages are run and call `gmx_mpi` and `dhdl_analysis.py`
+    threshold = int(failure * 32768)
+    header = f"""#!/usr/bin/env bash
+echo $(basename $0) >> {dirname}/calls
+sleep {latency}
+"""
+    scripts = {
+        "sbatch": f"""if [ $RANDOM -lt {threshold} ]; then
+    echo "sbatch: error: Batch job submission failed" >&2
+    exit 1
+fi
+n=$( (flock 9; n=$(cat {dirname}/jobid 2>/dev/null || echo 1000); echo $((n + 1)) > {dirname}/jobid; echo $n) 9>> {dirname}/jobid.lock )
+echo "Submitted batch job $n"
+""",
+        "squeue": "",
+        "sacct": f"""jobs=""
+format=""
+while [ $# -gt 0 ]; do
+    case $1 in
+        -j) jobs=$2; shift ;;
+        -o) format=$2; shift ;;
+    esac
+    shift
+done
+for job in ${{jobs//,/ }}; do
+    if [[ $format == *Partition* ]]; then
+        echo "$job|bench|2026-01-01T00:00:00|2026-01-01T00:01:00|2026-01-01T00:11:00|600|28800"
+    elif [ $RANDOM -lt {threshold} ]; then
+        echo "$job|FAILED"
+    else
+        echo "$job|COMPLETED"
+    fi
+done
+""",
+        "scancel": "",
+        "gmx_mpi": f"""if [ $RANDOM -lt {threshold} ]; then
+    exit 1
+fi
+""",
+        # writes the table of results (`--output`)
+        "dhdl_analysis.py": f"""if [ $RANDOM -lt {threshold} ]; then
+    exit 1
+fi
+while [ $# -gt 0 ]; do
+    if [ $1 == --output ]; then
+        echo "bench" > $2
+    fi
+    shift
+done
+""",
+        "module": "",
+    }
+    os.makedirs(f"{dirname}/bin")
+    for name in STUBS + ("module",):
+        open(f"{dirname}/bin/{name}", "w").write((header if name in STUBS else "#!/usr/bin/env bash\n") + scripts[name])
+        os.chmod(f"{dirname}/bin/{name}", 0o755)
+
+
+def campaign(dirname, ntasks, frames):
+    # directories with the (non-empty) results checked after every stage but result
+    # processing: MD preparation, MD, FEP preparation (frames, tpr files are built by
+    # FEP jobs) and FEP (dhdl with the end of the mdrun output); all files of a task
+    # are hard links of its two files (the number of links of a file is limited)
+    root = f"{dirname}/campaign-{ntasks}"
+    os.makedirs(root)
+    os.symlink(f"{dirname}/bin/dhdl_analysis.py", f"{root}/dhdl_analysis.py")
+    files = [("result", name) for name in ("eq.tpr", "eq.gro", "traj_comp.xtc")]
+    files += [("result", f"frame{frame}.gro") for frame in range(frames)]
+    files += [(source, f"dhdl{frame}.{extension}") for frame in range(frames)
+              for source, extension in (("result", "xvg"), ("log", "log_gmx"))]
+    for i in range(ntasks):
+        os.makedirs(f"{root}/task{i}")
+        open(f"{root}/task{i}/result", "w").write("x\n")
+        open(f"{root}/task{i}/log", "w").write("Finished mdrun\n")
+        for state, _, _ in FEP_pmx_db.FEP_STATES:
+            os.makedirs(f"{root}/task{i}/{state}")
+            for source, name in files:
+                os.link(f"{root}/task{i}/{source}", f"{root}/task{i}/{state}/{name}")
+    return root
+
+
+class TimedCursor:
+    # time spent in SQLite by the orchestrator; results are fetched at once
+    def __init__(self, cursor, timer):
+        self.cursor = cursor
+        self.timer = timer
+
+    def timed(self, function, *args):
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            self.timer[0] += time.perf_counter() - start
+
+    def execute(self, *args):
+        self.timed(self.cursor.execute, *args)
+        return self
+
+    def executemany(self, *args):
+        self.timed(self.cursor.executemany, *args)
+        return self
+
+    def fetchone(self):
+        return self.timed(self.cursor.fetchone)
+
+    def fetchall(self):
+        return self.timed(self.cursor.fetchall)
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class TimedConnection:
+    def __init__(self, db, timer):
+        self.db = db
+        self.timer = timer
+
+    def commit(self):
+        start = time.perf_counter()
+        self.db.commit()
+        self.timer[0] += time.perf_counter() - start
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+
+class CountedPopen(subprocess.Popen):
+    count = 0
+
+    def __init__(self, *args, **kwargs):
+        CountedPopen.count += 1
+        super().__init__(*args, **kwargs)
+
+
+def calls(dirname):
+    counts = dict.fromkeys(STUBS, 0)
+    if os.path.exists(f"{dirname}/calls"):
+        for line in open(f"{dirname}/calls"):
+            counts[line.strip()] += 1
+        os.remove(f"{dirname}/calls")
+    return counts
+
+
+def active(control):
+    # tasks that are neither finished nor failed
+    count, = control.db.execute(
+        "SELECT COUNT(*) FROM tasks_control WHERE status != 4 AND NOT (stage = 5 AND status = 5)").fetchone()
+    return count
+
+
+def bench(dirname, ntasks, passes, interval, workers, journal):
+    root = campaign(dirname, ntasks, FRAMES)
+    with contextlib.redirect_stdout(None):
+        control = FEP_pmx_db.FEPdb(f"{root}/FEP.db", executor="local", workers=workers, lazy_tpr=True, journal=journal)
+        start = time.perf_counter()
+        for i in range(ntasks):
+            control.add_task((f"task{i}", "1"), False)
+        control.db.commit()
+        add = time.perf_counter() - start
+    timer = [0.0]
+    control.run = TimedCursor(control.run, timer)
+    control.db = TimedConnection(control.db, timer)
+    rows = []
+    for number in range(passes):
+        if number > 0:
+            if active(control) == 0:
+                break
+            time.sleep(interval)
+        timer[0] = 0.0
+        CountedPopen.count = 0
+        with contextlib.redirect_stdout(None):
+            start = time.perf_counter()
+            changed = control.run_tasks()
+            elapsed = time.perf_counter() - start
+        rows.append((number + 1, elapsed, CountedPopen.count, calls(dirname), timer[0], changed, active(control)))
+    with contextlib.redirect_stdout(None):
+        start = time.perf_counter()
+        control.dump(f"{root}/FEP.csv")
+        dump = time.perf_counter() - start
+        del control
+    # local stages still running when --passes is reached
+    with contextlib.suppress(ChildProcessError):
+        while True:
+            os.wait()
+    return add, dump, rows
+
+
+if __name__ == "__main__":
+    args = parse()
+    with tempfile.TemporaryDirectory(dir=args.dir) as dirname:
+        stubs(dirname, args.latency, args.failure)
+        os.environ["PATH"] = f"{dirname}/bin:{os.environ['PATH']}"
+        subprocess.Popen = CountedPopen
+        for ntasks in args.tasks:
+            add, dump, rows = bench(dirname, ntasks, args.passes, args.interval, args.workers, args.journal)
+            print(f"{ntasks} tasks: add {add:.4f} s, dump {dump:.4f} s")
+            print(f"{'pass':>6} {'time, s':>10} {'subprocesses':>13} " +
+                  " ".join(f"{name:>{max(8, len(name))}}" for name in STUBS) + f" {'DB, s':>10} {'changed':>8} {'active':>8}")
+            for number, elapsed, count, counts, db, changed, left in rows:
+                print(f"{number:>6} {elapsed:>10.4f} {count:>13} " +
+                      " ".join(f"{counts[name]:>{max(8, len(name))}}" for name in STUBS) + f" {db:>10.4f} {changed:>8} {left:>8}")
+            print()
@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import glob
+import json
+import mmap
+import tarfile
+import argparse
+
+import numpy as np
+
+import extract
+
+KB = 0.0083144626  # kJ/(mol*K)
+LEGS = {"water": ("stateA_water", "stateB_water"),
+        "protein": ("stateA_protein", "stateB_protein")}
+ARCHIVE = "dhdl.tar.gz"  # per-frame files of a state packed by Result processing (`--compact`)
+
+
+def parse():
+    parser = argparse.ArgumentParser(
+        description='Calculate dG from dhdl*.xvg files', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        '--path',
+        help="Path to directory of calculations (with stateA_water, stateB_water, stateA_protein, stateB_protein)",
+        required=True)
+    parser.add_argument(
+        '--output',
+        help="Path to result_XXX.csv",
+        required=True)
+    parser.add_argument(
+        '--protein_name',
+        help="Name of directory; default is the basename of --path")
+    parser.add_argument(
+        '-t',
+        '--temperature',
+        type=float,
+        default=298.0,
+        help="Temperature, K")
+    parser.add_argument(
+        '--nboots',
+        type=int,
+        default=100,
+        help="Number of bootstrap samples")
+    parser.add_argument(
+        '--seed',
+        type=int,
+        help="Seed of random generator for bootstrap")
+    args = parser.parse_args()
+    if args.protein_name == None:
+        args.protein_name = os.path.basename(os.path.abspath(args.path))
+    return args
+
+
+def parse_xvg(data):
+    # all numbers after the header are parsed at once; an incomplete last line
+    # (mdrun is still writing the file) is dropped
+    start = 0
+    while start < len(data) and data[start:start + 1] in (b"#", b"@", b"&", b"\n"):
+        start = data.find(b"\n", start)
+        start = len(data) if start == -1 else start + 1
+    end = data.rfind(b"\n") + 1
+    if end <= start:
+        return np.zeros((0, 0))
+    first = data.find(b"\n", start)
+    ncolumns = len(data[start:first].split())
+    values = np.array(data[start:end].split(), dtype=float)
+    nrows = len(values) // ncolumns
+    return values[:nrows * ncolumns].reshape(nrows, ncolumns)
+
+
+def read_xvg(filename):
+    with open(filename, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return np.zeros((0, 0))
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return parse_xvg(data)
+
+
+def work(filename, lambda0, data=None):
+    # dH/dl integrated over lambda, which goes linearly from lambda0
+    # (0 for forward, 1 for reverse transitions) to 1 - lambda0;
+    # `data` - parsed contents of the file, if it is not read from the disk
+    if data is None:
+        data = read_xvg(filename)
+    if len(data) < 2:
+        return None
+    dlambda = 1.0 / len(data)
+    if lambda0 == 1:
+        dlambda *= -1
+    lambdas = lambda0 + dlambda * np.arange(len(data))
+    return float(np.sum((data[1:, 1] + data[:-1, 1]) * np.diff(lambdas)) / 2)
+
+
+def works(filenames, lambda0):
+    result = []
+    for filename in filenames:
+        value = work(filename, lambda0)
+        if value == None:
+            print(f"'{filename}' has no data, skipping it")
+            continue
+        result.append(value)
+    return np.array(result)
+
+
+def log_finished(end):
+    # the end of mdrun output
+    return b"Performance:" in end or b"Finished mdrun" in end
+
+
+def finished(filename):
+    # mdrun of the frame has reached its end; files without mdrun output are taken as they are
+    log = filename[:-len(".xvg")] + ".log_gmx"
+    if not os.path.exists(log):
+        return True
+    with open(log, "rb") as f:
+        f.seek(max(0, os.fstat(f.fileno()).st_size - 4096))
+        return log_finished(f.read())
+
+
+def archive_works(directory, lambda0, cache):
+    # works of dhdl*.xvg packed into the archive of the state; the archive itself is kept
+    # in the cache with the names of its files, so that it is opened only when changed
+    archive = f"{directory}/{ARCHIVE}"
+    if not os.path.exists(archive):
+        return {}
+    stat = os.stat(archive)
+    entry = cache.get(ARCHIVE)
+    if entry != None and entry[0] == stat.st_size and entry[1] == stat.st_mtime and \
+            all(name in cache for name in entry[2]):
+        updated = {name: cache[name] for name in entry[2]}
+    else:
+        updated, logs = {}, {}
+        with tarfile.open(archive) as tar:
+            for member in tar:
+                name = os.path.basename(member.name)
+                if not member.isfile() or not name.startswith("dhdl"):
+                    continue
+                if name.endswith(".log_gmx"):
+                    logs[name[:-len(".log_gmx")] + ".xvg"] = log_finished(tar.extractfile(member).read()[-4096:])
+                    continue
+                if not name.endswith(".xvg"):
+                    continue
+                entry = cache.get(name)
+                if entry != None and entry[0] == member.size and entry[1] == member.mtime:
+                    updated[name] = entry
+                else:
+                    updated[name] = [member.size, member.mtime,
+                                     work(name, lambda0, parse_xvg(tar.extractfile(member).read()))]
+        # as with `finished`, files without mdrun output are taken as they are
+        updated = {name: updated[name] for name in updated if logs.get(name, True)}
+    updated[ARCHIVE] = [stat.st_size, stat.st_mtime, sorted(updated)]
+    return updated
+
+
+def cached_works(directory, lambda0, frames=None):
+    # works of the finished dhdl*.xvg files of a state directory (only of `frames` if given),
+    # including the packed ones; they are kept in `works.json` by file name, size and mtime,
+    # so that every file is read once, as soon as its frame is finished
+    cache_file = f"{directory}/works.json"
+    cache = {}
+    if os.path.exists(cache_file):
+        try:
+            cache = json.load(open(cache_file))
+        except ValueError:
+            pass
+    # files outside of the archive are newer
+    updated = archive_works(directory, lambda0, cache)
+    for filename in sorted(glob.glob(f"{directory}/dhdl*.xvg")):
+        name = os.path.basename(filename)
+        stat = os.stat(filename)
+        entry = cache.get(name)
+        if entry != None and entry[0] == stat.st_size and entry[1] == stat.st_mtime:
+            updated[name] = entry
+        elif finished(filename):
+            updated[name] = [stat.st_size, stat.st_mtime, work(filename, lambda0)]
+    if updated != cache:
+        tmp = f"{cache_file}.{os.getpid()}"
+        json.dump(updated, open(tmp, "w"))
+        os.replace(tmp, cache_file)
+    names = {name for name in updated if name != ARCHIVE}
+    if frames != None:
+        names &= {f"dhdl{frame}.xvg" for frame in frames}
+    values = []
+    for name in sorted(names):
+        if updated[name][2] == None:
+            print(f"'{directory}/{name}' has no data, skipping it")
+            continue
+        values.append(updated[name][2])
+    return np.array(values)
+
+
+def logmeanexp(values):
+    top = np.max(values, axis=-1, keepdims=True)
+    return np.log(np.mean(np.exp(values - top), axis=-1)) + top[..., 0]
+
+
+def jarzynski(wf, wr, beta):
+    # forward and reverse estimates along the last axis
+    forward = -logmeanexp(-beta * wf) / beta
+    reverse = logmeanexp(-beta * wr) / beta
+    return forward, reverse
+
+
+def cgi(wf, wr):
+    # intersection of Gaussians fitted to forward and (negated) reverse works
+    m1, s1 = np.mean(wf, axis=-1), np.std(wf, axis=-1, ddof=1)
+    m2, s2 = np.mean(-wr, axis=-1), np.std(wr, axis=-1, ddof=1)
+    a = 1 / (2 * s2 ** 2) - 1 / (2 * s1 ** 2)
+    b = m1 / s1 ** 2 - m2 / s2 ** 2
+    c = m2 ** 2 / (2 * s2 ** 2) - m1 ** 2 / (2 * s1 ** 2) + np.log(s2 / s1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        root = np.sqrt(np.maximum(b ** 2 - 4 * a * c, 0))
+        x1 = (-b + root) / (2 * a)
+        x2 = (-b - root) / (2 * a)
+    middle = (m1 + m2) / 2
+    # the root closest to the middle of the means lies between them
+    dG = np.where(np.abs(x1 - middle) < np.abs(x2 - middle), x1, x2)
+    return np.where(np.abs(a) < 1e-12, middle, dG)
+
+
+def fermi(x):
+    return 0.5 * (1 - np.tanh(x / 2))
+
+
+def bar(wf, wr, beta, iterations=100):
+    # bisection for all bootstrap samples at once
+    M = np.log(wf.shape[-1] / wr.shape[-1])
+    low = np.minimum(np.min(wf, axis=-1), np.min(-wr, axis=-1)) - 100 / beta
+    high = np.maximum(np.max(wf, axis=-1), np.max(-wr, axis=-1)) + 100 / beta
+    for _ in range(iterations):
+        dG = (low + high) / 2
+        f = np.sum(fermi(M + beta * (wf - dG[..., None])), axis=-1) - \
+            np.sum(fermi(-M + beta * (wr + dG[..., None])), axis=-1)
+        low = np.where(f < 0, dG, low)
+        high = np.where(f < 0, high, dG)
+    return (low + high) / 2
+
+
+def estimate(wf, wr, temperature=298.0, nboots=100, seed=None):
+    beta = 1 / (KB * temperature)
+    wf = np.asarray(wf, dtype=float)
+    wr = np.asarray(wr, dtype=float)
+    rng = np.random.RandomState(seed)
+    bf = wf[rng.randint(0, len(wf), (nboots, len(wf)))]
+    br = wr[rng.randint(0, len(wr), (nboots, len(wr)))]
+    forward, reverse = jarzynski(wf, wr, beta)
+    bforward, _ = jarzynski(bf, br, beta)
+    return {
+        "CGI": {"dG": float(cgi(wf, wr)), "SD": float(np.std(cgi(bf, br), ddof=1))},
+        "BAR": {"dG": float(bar(wf, wr, beta)), "SD": float(np.std(bar(bf, br, beta), ddof=1))},
+        "JARZ": {"dG": float((forward + reverse) / 2), "SD": float(np.std(bforward, ddof=1))},
+    }
+
+
+def analyze(path, leg, temperature=298.0, nboots=100, seed=None):
+    stateA, stateB = LEGS[leg]
+    # works of most frames are already in works.json, see `cached_works`
+    wf = cached_works(f"{path}/{stateA}", 0)
+    wr = cached_works(f"{path}/{stateB}", 1)
+    if len(wf) < 2 or len(wr) < 2:
+        print(f"Not enough dhdl*.xvg files in '{path}/{stateA}' and '{path}/{stateB}'!")
+        return None
+    return estimate(wf, wr, temperature, nboots, seed)
+
+
+def as_text(result):
+    # the same representation as extract.get_data returns
+    return {key: {value: f"{result[key][value]:.2f}" for value in result[key]} for key in result}
+
+
+def results_text(result):
+    # the lines of analyze_dhdl.py output that extract.get_data looks for
+    text = as_text(result)
+    return f"""  CGI: dG = {text["CGI"]["dG"]} kJ/mol
+  CGI: Std Err (bootstrap) = {text["CGI"]["SD"]} kJ/mol
+  BAR: dG = {text["BAR"]["dG"]} kJ/mol
+  BAR: Std Err (bootstrap)  = {text["BAR"]["SD"]} kJ/mol
+  JARZ: dG Mean    = {text["JARZ"]["dG"]} kJ/mol
+  JARZ: Std Err Forward (bootstrap) = {text["JARZ"]["SD"]} kJ/mol
+"""
+
+
+if __name__ == "__main__":
+    args = parse()
+    results = {}
+    for leg in LEGS:
+        results[leg] = analyze(args.path, leg, args.temperature, args.nboots, args.seed)
+        if results[leg] == None:
+            sys.exit(1)
+        os.makedirs(f"{args.path}/result_{leg}", exist_ok=True)
+        open(f"{args.path}/result_{leg}/results_{leg}.txt", "w").write(results_text(results[leg]))
+    open(args.output, "w").write(extract.build_table(args.protein_name,
+                                                     as_text(results["protein"]), as_text(results["water"])))